@@ -2,7 +2,8 @@ from __future__ import division
 import argparse
 import datetime
 import rrdtool
-import math
+import multiprocessing
+import numpy
 from ConfigParser import SafeConfigParser
 from psycopg2.tz import LocalTimezone
 from twistedfcp.protocol import FreenetClientProtocol, Message
@@ -15,8 +16,15 @@ import logging
 import codecs
 from fnprobe.time_utils import toPosix, fromPosix, get_midnight, totalSeconds,\
     clamp_to_hour
-from fnprobe.gnuplots import plot_link_length, plot_location_dist, plot_peer_count, plot_bulk_reject, reject_types, plot_uptime
-from fnprobe.db import Database, errorTypes
+from fnprobe.gnuplots import plot_link_length, plot_location_dist, plot_peer_count, plot_bulk_reject, plot_uptime, link_length_edges
+from fnprobe.plotting import backends
+from fnprobe.reference import link_length_cdf
+from fnprobe.db import Database
+from fnprobe.rrd_graphs import Graph, render_graphs
+from fnprobe.size import size_interval
+from fnprobe.stages import Stage, run_stages
+from fnprobe.backfill import count_hours, count_chunk, split_range, \
+    start_worker
 import locale
 
 parser = argparse.ArgumentParser(description="Analyze probe results for estimates of peer distribution and network interconnectedness; generate plots.")
@@ -43,6 +51,15 @@ parser.add_argument('--datastore-graph', dest='datastoreGraph',
                     help='Path to the datastore size graph.')
 parser.add_argument('--error-refused-graph', dest='errorRefusedGraph', default='plot_error_refused.png',
                     help='Path to the errors and refusals graph.')
+parser.add_argument('--graph-jobs', dest='graphJobs',
+                    default=multiprocessing.cpu_count(), type=int,
+                    help='Number of processes to render the RRDTool graphs '
+                         'in. Defaults to the number of CPUs.')
+parser.add_argument('--graph-cache', dest='graphCache',
+                    default='rrd-graph-cache.json',
+                    help='File recording what each RRDTool graph was last '
+                         'rendered from, so that unchanged ones are not '
+                         'rendered again. Default rrd-graph-cache.json.')
 parser.add_argument('--uptime-histogram-max', dest="uptimeHistogramMax", default=120, type=int,
                     help='Maximum percentage to include in the uptime histogram. Default 120')
 # Default to midnight today in the local timezone. Allow specifying date and
@@ -70,6 +87,22 @@ parser.add_argument('--uptime-filename', dest='uptimeGraphFile',
                     default='plot_week_uptime.png')
 parser.add_argument('--bulk-reject-filename', dest='bulkRejectFile',
                     default='plot_week_reject.png')
+parser.add_argument('--reference-cache', dest='referenceCache',
+                    default='reference-cache',
+                    help='Directory to cache the simulated reference link '
+                         'length distributions in. Default reference-cache.')
+parser.add_argument('--plot-backend', dest='plotBackend', default='gnuplot',
+                    choices=sorted(backends),
+                    help='How to render plots other than the RRDTool ones: '
+                         'gnuplot with Gnuplot-py, or in-process with '
+                         'matplotlib. Default gnuplot.')
+parser.add_argument('--stage-jobs', dest='stageJobs',
+                    default=multiprocessing.cpu_count(), type=int,
+                    help='Number of stages of analysis, such as updating the '
+                         'round robin database and each plot, to run at '
+                         'once. Each runs in its own process with its own '
+                         'database connection. Defaults to the number of '
+                         'CPUs.')
 
 # Which segments of analysis to run.
 parser.add_argument('--upload', dest='uploadConfig', default=None,
@@ -81,6 +114,25 @@ parser.add_argument('--markdown', dest='markdownFiles', default=None,
 parser.add_argument('--rrd', dest='runRRD', default=False, action='store_true',
                     help='If specified updates and renders the RRDTool plots.')
 
+parser.add_argument('--approximate', dest='approximate', default=False,
+                    action='store_true',
+                    help='Estimate network size from per-hour sketches of '
+                         'identifiers instead of exact counts. This is '
+                         'faster over long spans but less accurate; '
+                         'sketch-accuracy.py reports by how much.')
+
+parser.add_argument('--jobs', dest='jobs', default=1, type=int,
+                    help='Number of processes, each with its own database '
+                         'connection, to compute network size hours in. '
+                         'Useful when rebuilding the round robin database. '
+                         'Default 1.')
+parser.add_argument('--chunk-hours', dest='chunkHours', default=720,
+                    type=int,
+                    help='Number of hours to compute at once, in each '
+                         'process with --jobs, before writing them to the '
+                         'round robin database. Each chunk also reads the '
+                         'two weeks of identifiers before it. Default 720.')
+
 parser.add_argument('--location', dest='runLocation', default=False, action='store_true',
                     help='If specified plots location distribution over the last recency period.')
 parser.add_argument('--peer-count', dest='runPeerCount', default=False, action='store_true',
@@ -120,6 +172,9 @@ recent = startTime - datetime.timedelta(hours=args.recentHours)
 log("Analyzing up to %s. Recency boundary is %s." % (startTime, recent))
 
 log("Connecting to database.")
+# Stages and worker processes open their own connections with the same
+# configuration.
+databaseConfig = dict(config)
 db = Database(config)
 
 # Period of time to consider samples in a group for an instantaneous estimate.
@@ -217,7 +272,21 @@ except IOError:
                    *datasources
                    )
 
-if args.runRRD:
+# Each stage of analysis is a function run in its own process by
+# fnprobe.stages.run_stages().
+
+
+def stageDatabase():
+    """
+    Return a database with a reading connection for the stage running in
+    this process.
+    """
+    return Database(databaseConfig, read_only=True)
+
+
+def updateRRD():
+    db = stageDatabase()
+
     #
     # Start computation where the stored values left off, if any.
     # If the database is new rrdtool last returns the database start time.
@@ -227,120 +296,81 @@ if args.runRRD:
     toTime = fromTime + shortPeriod
     log("Resuming network size computation for %s to %s." % (fromTime, toTime))
 
-    def formula(samples, networkSize):
-        return networkSize * (1 - math.e**(-samples/networkSize))
-
-    def binarySearch(distinctSamples, samples):
-        # TODO: Is 3 reasonable? Seems arbitrary. How to tell better?
-        if math.fabs(samples - distinctSamples) < 3:
-            # Not enough information to make an estimate.
-            return float('NaN')
-        # Upper and lower are network size guesses.
-        lower = distinctSamples
-        upper = distinctSamples * 2
-
-        #log("Starting: distinct {0}, samples {1}, lower {2}, upper {3}".format(distinctSamples, samples, lower, upper))
-
-        # Find an upper bound - multiply by two until too large.
-        while formula(samples, upper) < distinctSamples:
-            upper *= 2
-
-        while True:
-            #log("lower {0}, upper {1}".format(lower, upper))
-            # Got as close as possible. Lower can be greater than upper with certain
-            # values of mid.
-            if lower >= upper:
-                return lower
-
-            mid = int((upper - lower) / 2) + lower
-            current = formula(samples, mid)
-
-            if current < distinctSamples:
-                lower = mid + 1
-                continue
-            elif current > distinctSamples:
-                upper = mid - 1
-                continue
-            else:
-                # current == distinctSamples:
-                return mid
-
     log("Computing network plot data. In-progress segment is %s. (POSIX %s)" %
         (startTime, toPosix(startTime)))
 
     #
-    # Perform binary search for network size in:
+    # Solve for network size in:
     # (distinct samples) = (network size) * (1 - e^(-1 * (samples)/(network size)))
     # ----Effective size estimate:
     # Identifiers that appear in the current long time period in the past, as well as
     # the period of the same length farther back.
     # ----Instantaneous size estimate:
     # Identifiers that appear in the current short time period in the past.
-    while startTime >= toTime:
-
-        # Start of current effective size estimate period.
-        fromTimeEffective = toTime - longPeriod
-        # Start of previous effective size estimate period.
-        fromTimeEffectivePrevious = toTime - 2*longPeriod
-
-        log("Computing %s to %s." % (fromTime, toTime))
-
-        weekEffectiveResult = db.intersect_identifier(fromTimeEffectivePrevious, fromTimeEffective, toTime)
-
-        effectiveSize = binarySearch(weekEffectiveResult[0], weekEffectiveResult[1])
-
-        log("%s samples | %s distinct samples | %s estimated weekly effective"
-            " size" % (weekEffectiveResult[1], weekEffectiveResult[0],
-                       effectiveSize))
-
-        # Start of current daily effective size estimate period.
-        fromTimeDaily = toTime - mediumPeriod
-        # Start of previous daily effective size estimate period.
-        fromTimeDailyPrevious = toTime - 2*mediumPeriod
-
-        dailyEffectiveResult = db.intersect_identifier(fromTimeDailyPrevious, fromTimeDaily, toTime)
-
-        dailySize = binarySearch(dailyEffectiveResult[0], dailyEffectiveResult[1])
-
-        log("%s samples | %s distinct samples | %s estimated daily effective "
-            "size" % (dailyEffectiveResult[1], dailyEffectiveResult[0],
-                      dailySize))
-
-        instantaneousResult = db.span_identifier(fromTime, toTime)
-
-        instantaneousSize = binarySearch(instantaneousResult[0], instantaneousResult[1])
-        log("%s samples | %s distinct samples | %s estimated instantaneous "
-            "size" % (instantaneousResult[1], instantaneousResult[0],
-                      instantaneousSize))
-
-        # Past week of datastore sizes.
-        meanDatastoreSize = db.span_store_size(fromTimeEffective, toTime)
-
-        # 1073741824 bytes per GiB,
-        estimatedDatastore = meanDatastoreSize * effectiveSize * 1073741824
-
-        refused = db.span_refused(fromTime, toTime)
-
-        # Get numbers of each error type. An error type with zero count does
-        # not return a row, so list entries must be made manually.
-        errors = [0] * len(errorTypes)
-        for index, count in db.span_error_count(fromTime, toTime):
-            errors[index] = count
-
-        # RRDTool format string to explicitly specify the order of the data sources.
-        # The first one is implicitly the time of the sample.
-        try:
-            rrdtool.update(args.rrd,
-                       '-t', 'instantaneous-size:daily-size:effective-size:datastore-capacity:refused:' + join(errorDataSources, ':'),
-                       join(map(str, [toPosix(toTime), instantaneousSize, dailySize, effectiveSize, estimatedDatastore, refused] + errors), ':'))
-        except rrdtool.error as e:
-            log("Failed to update RRD: {0}".format(e))
-
-        fromTime = toTime
-        toTime = fromTime + shortPeriod
+    #
+    # Rather than query each span for every estimate, identifiers seen in each
+    # shortPeriod are read once, in order, and added to sliding spans. With
+    # --approximate, the spans are merges of per-hour sketches instead. See
+    # fnprobe.backfill.count_hours(). shortPeriod must be an hour to match
+    # the sketches.
+    #
+    # The range is split into chunks of hours, and the counts for each
+    # chunk are gathered first so that sizes for all of them can be solved
+    # for at once. Each chunk is written as it completes, in order, so an
+    # interrupted run keeps its progress. With --jobs, chunks are counted in
+    # parallel.
+    #
+    shortPeriodSeconds = totalSeconds(shortPeriod)
+    countArguments = (args.approximate,
+                      int(totalSeconds(mediumPeriod) / shortPeriodSeconds),
+                      int(totalSeconds(longPeriod) / shortPeriodSeconds))
+
+    def writeHours(hours):
+        # Columns are instantaneous, daily, and weekly.
+        sizes, lowers, uppers = size_interval(
+            numpy.array([hour['distinct'] for hour in hours]).reshape(-1, 3),
+            numpy.array([hour['samples'] for hour in hours]).reshape(-1, 3))
+
+        for hour, size, lower, upper in zip(hours, sizes, lowers, uppers):
+            instantaneousSize, dailySize, effectiveSize = size
+
+            log("Estimates for the hour before %s:" % hour['time'])
+            for name, index in [('instantaneous', 0), ('daily effective', 1),
+                                ('weekly effective', 2)]:
+                log("%s samples | %s distinct samples | %s estimated %s size "
+                    "(95%% interval %s to %s)" %
+                    (hour['samples'][index], hour['distinct'][index], size[index],
+                     name, lower[index], upper[index]))
+
+            # 1073741824 bytes per GiB,
+            estimatedDatastore = hour['datastore'] * effectiveSize * 1073741824
+
+            # RRDTool format string to explicitly specify the order of the data sources.
+            # The first one is implicitly the time of the sample.
+            try:
+                rrdtool.update(args.rrd,
+                           '-t', 'instantaneous-size:daily-size:effective-size:datastore-capacity:refused:' + join(errorDataSources, ':'),
+                           join(map(str, [toPosix(hour['time']), instantaneousSize, dailySize, effectiveSize, estimatedDatastore, hour['refused']] + hour['errors']), ':'))
+            except rrdtool.error as e:
+                log("Failed to update RRD: {0}".format(e))
+
+    chunks = split_range(fromTime, startTime, args.chunkHours)
+    if args.jobs > 1:
+        log("Counting {0} chunks in {1} processes.".format(len(chunks),
+                                                           args.jobs))
+        pool = multiprocessing.Pool(args.jobs, start_worker, (databaseConfig,))
+        for hours in pool.imap(count_chunk, [chunk + countArguments
+                                             for chunk in chunks]):
+            writeHours(hours)
+        pool.close()
+        pool.join()
+    else:
+        for chunk in chunks:
+            writeHours(count_hours(db, *(chunk + countArguments)))
 
     # Graph all available information with a 2-pixel red line.
     lastResult = rrdtool.last(args.rrd)
+    step = int(totalSeconds(shortPeriod))
 
     # Distant colors are not easily confused.
     # See http://citeseerx.ist.psu.edu/viewdoc/summary?doi=10.1.1.65.2790
@@ -366,107 +396,123 @@ if args.runRRD:
                        errorPlotNames + ['Refused'],
                        colors)
 
-    refusedAndErrors = ['DEF:{0}={1}:{0}:AVERAGE:step={2}'.format(pair[0], args.rrd, int(totalSeconds(shortPeriod)))
+    refusedAndErrors = ['DEF:{0}={1}:{0}:AVERAGE:step={2}'.format(pair[0], args.rrd, step)
                         for pair in sourcesNames]
     refusedAndErrors += ['AREA:{0}{1}:{2}:STACK'.format(pair[0], pair[2], pair[1])
                          for pair in sourcesNames]
 
+    # Graph filename, vertical label, and lines.
+    graphs = [
+        (args.sizeGraph, 'Size Estimate', [
+            # Each data source has a new value each shortPeriod, even if it
+            # involves data over a longer period.
+            'DEF:instantaneous-size={0}:instantaneous-size:AVERAGE:step={1}'.format(args.rrd, step),
+            'DEF:daily-size={0}:daily-size:AVERAGE:step={1}'.format(args.rrd, step),
+            'DEF:effective-size={0}:effective-size:AVERAGE:step={1}'.format(args.rrd, step),
+            'LINE2:instantaneous-size#FF0000:Hourly Instantaneous',
+            'LINE2:daily-size#0099FF:Daily Effective',
+            'LINE2:effective-size#0000FF:Weekly Effective',
+        ]),
+        (args.datastoreGraph, 'Datastore Capacity', [
+            'DEF:datastore-capacity={0}:datastore-capacity:AVERAGE:step={1}'.format(args.rrd, step),
+            'AREA:datastore-capacity#0000FF',
+        ]),
+        (args.errorRefusedGraph, 'Errors and Refused', refusedAndErrors),
+    ]
+
     # Year: 3600 * 24 * 365 = 31536000 seconds
     # Month: 3600 * 24 * 30 = 2592000 seconds
     # Week: 3600 * 24 * 7 = 604800 seconds
-    # Period name, start.
-    for period in [('year', lastResult - 31536000), ('month', lastResult - 2592000), ('week', lastResult - 604800)]:
-        # Width, height.
-        for dimension in [(900, 300), (1200, 400)]:
-            rrdtool.graph(args.outputDir + '/{0}_{1}x{2}_{3}'.format(period[0], dimension[0], dimension[1], args.sizeGraph),
-                          '--start', str(period[1]),
-                          '--end', str(lastResult),
-                          # Each data source has a new value each shortPeriod,
-                          # even if it involves data over a longer period.
-                          'DEF:instantaneous-size={0}:instantaneous-size:AVERAGE:step={1}'.format(args.rrd, int(totalSeconds(shortPeriod))),
-                          'DEF:daily-size={0}:daily-size:AVERAGE:step={1}'.format(args.rrd, int(totalSeconds(shortPeriod))),
-                          'DEF:effective-size={0}:effective-size:AVERAGE:step={1}'.format(args.rrd, int(totalSeconds(shortPeriod))),
-                          'LINE2:instantaneous-size#FF0000:Hourly Instantaneous',
-                          'LINE2:daily-size#0099FF:Daily Effective',
-                          'LINE2:effective-size#0000FF:Weekly Effective',
-                          '-v', 'Size Estimate',
-                          '--right-axis', '1:0',
-                          '--full-size-mode',
-                          '--width', str(dimension[0]),
-                          '--height', str(dimension[1])
-                          )
-
-            rrdtool.graph(args.outputDir + '/{0}_{1}x{2}_{3}'.format(period[0], dimension[0], dimension[1], args.datastoreGraph),
-                          '--start', str(period[1]),
-                          '--end', str(lastResult),
-                          'DEF:datastore-capacity={0}:datastore-capacity:AVERAGE:step={1}'.format(args.rrd, int(totalSeconds(shortPeriod))),
-                          'AREA:datastore-capacity#0000FF',
-                          '-v', 'Datastore Capacity',
-                          '--right-axis', '1:0',
-                          '--full-size-mode',
-                          '--width', str(dimension[0]),
-                          '--height', str(dimension[1])
-                          )
-
-            rrdtool.graph(args.outputDir + '/{0}_{1}x{2}_{3}'.format(period[0], dimension[0], dimension[1], args.errorRefusedGraph),
-                          '--start', str(period[1]),
-                          '--end', str(lastResult),
-                          '-v', 'Errors and Refused',
-                          '--right-axis', '1:0',
-                          '--full-size-mode',
-                          '--width', str(dimension[0]),
-                          '--height', str(dimension[1]),
-                          *refusedAndErrors
-                          )
-
-if args.runLocation:
+    # Period name, length.
+    periods = [('year', 31536000), ('month', 2592000), ('week', 604800)]
+
+    # Width, height.
+    dimensions = [(900, 300), (1200, 400)]
+
+    specs = [Graph(args.outputDir + '/{0}_{1}x{2}_{3}'.format(period, width, height, filename),
+                   ['--start', str(lastResult - length),
+                    '--end', str(lastResult),
+                    '-v', label,
+                    '--right-axis', '1:0',
+                    '--full-size-mode',
+                    '--width', str(width),
+                    '--height', str(height)] + lines)
+             for period, length in periods
+             for width, height in dimensions
+             for filename, label, lines in graphs]
+
+    rendered = render_graphs(specs, args.rrd, args.graphCache, args.graphJobs)
+    log("Rendered {0} of {1} network size graphs; the rest are unchanged."
+        .format(rendered, len(specs)))
+
+
+def renderPlot(plot):
+    backends[args.plotBackend](plot)
+
+
+def plotLocations():
+    db = stageDatabase()
     log("Querying database for locations.")
     locations = db.span_locations(recent, startTime)
 
-    log("Plotting.")
-    plot_location_dist(locations,
-                       filename=args.outputDir + '/' + args.locationGraphFile)
+    log("Plotting locations.")
+    renderPlot(plot_location_dist(
+        locations, filename=args.outputDir + '/' + args.locationGraphFile))
+
 
-if args.runPeerCount:
+def plotPeerCount():
+    db = stageDatabase()
     log("Querying database for peer distribution histogram.")
     rawPeerCounts = db.span_peer_count(recent, startTime)
 
-    log("Plotting.")
-    plot_peer_count(rawPeerCounts, args.histogramMax,
-                    filename=args.outputDir + '/' + args.peerCountGraphFile)
+    log("Plotting peer count distribution.")
+    renderPlot(plot_peer_count(
+        rawPeerCounts, args.histogramMax,
+        filename=args.outputDir + '/' + args.peerCountGraphFile))
 
-if args.runLinkLengths:
+
+def plotLinkLengths():
+    db = stageDatabase()
     log("Querying database for link lengths.")
     links = db.span_links(recent, startTime)
 
-    log("Plotting.")
-    plot_link_length(links,
-                     filename=args.outputDir + '/' + args.linkGraphFile)
+    references = [(title, link_length_cdf(kind, link_length_edges,
+                                          cache_dir=args.referenceCache))
+                  for title, kind in [('Ideal', 'kleinberg'),
+                                      ('Flat', 'uniform')]]
+
+    log("Plotting link lengths.")
+    renderPlot(plot_link_length(
+        links, references, filename=args.outputDir + '/' + args.linkGraphFile))
+
 
-if args.runUptime:
+def plotUptime():
+    db = stageDatabase()
     log("Querying database for uptime reported with identifiers.")
     # Note that the uptime percentage on the identifier probes is an integer.
     uptimes = db.span_uptimes(recent, startTime)
 
-    log("Plotting.")
-    plot_uptime(uptimes, args.uptimeHistogramMax,
-                filename=args.outputDir + '/' + args.uptimeGraphFile)
+    log("Plotting uptimes.")
+    renderPlot(plot_uptime(
+        uptimes, args.uptimeHistogramMax,
+        filename=args.outputDir + '/' + args.uptimeGraphFile))
 
-if args.bulkReject:
-    counts = {}
 
-    for reject_type in reject_types:
-        log("Querying database for {0} reports.".format(reject_type))
-        counts[reject_type] = db.span_bulk_rejects(reject_type, recent, startTime)
+def plotBulkReject():
+    db = stageDatabase()
+    log("Querying database for bulk reject reports.")
+    counts = db.span_reject_histograms(recent, startTime)
 
-    log("Plotting.")
-    plot_bulk_reject(counts,
-                     filename=args.outputDir + '/' + args.bulkRejectFile)
+    log("Plotting bulk rejects.")
+    renderPlot(plot_bulk_reject(
+        counts, filename=args.outputDir + '/' + args.bulkRejectFile))
 
 # TODO: Instead of always appending ".html", replace an extension if it exists, otherwise append.
 # TODO: Different headers for different pages.
 header = '<title>Freenet Statistics</title>'
-if args.markdownFiles is not None:
+
+
+def renderMarkdown():
     # The Markdown module uses Python logging.
     logging.basicConfig(filename="markdown.log")
 
@@ -507,21 +553,6 @@ if args.markdownFiles is not None:
                 # Close
                 markdownOutput.write("</html>")
 
-if args.uploadConfig is None:
-    # Upload config not specified; no further operations needed.
-    sys.exit(0)
-
-
-config = SafeConfigParser()
-config.read(args.uploadConfig)
-defaults = config.defaults()
-
-privkey = defaults['privkey']
-path = defaults['path']
-host = defaults['host']
-port = int(defaults['port'])
-scriptPath = os.path.dirname(os.path.realpath(__file__))
-
 
 class InsertFCPFactory(protocol.ClientFactory):
     """
@@ -530,7 +561,7 @@ class InsertFCPFactory(protocol.ClientFactory):
     """
     protocol = FreenetClientProtocol
 
-    def __init__(self):
+    def __init__(self, privkey, path):
         self.Identifier = 'Statistics Page Insert {0}'.format(startTime)
         # TODO: Why doesn't twistedfcp use a dictionary for fields?
         self.fields = [
@@ -597,5 +628,39 @@ class InsertFCPFactory(protocol.ClientFactory):
 
         return proto
 
-reactor.connectTCP(host, port, InsertFCPFactory())
-reactor.run()
+def upload():
+    config = SafeConfigParser()
+    config.read(args.uploadConfig)
+    defaults = config.defaults()
+
+    host = defaults['host']
+    port = int(defaults['port'])
+
+    reactor.connectTCP(host, port, InsertFCPFactory(defaults['privkey'],
+                                                    defaults['path']))
+    reactor.run()
+
+
+stages = []
+if args.runRRD:
+    stages.append(Stage('rrd', updateRRD, []))
+for enabled, name, function in [(args.runLocation, 'location', plotLocations),
+                                (args.runPeerCount, 'peer-count',
+                                 plotPeerCount),
+                                (args.runLinkLengths, 'link-lengths',
+                                 plotLinkLengths),
+                                (args.runUptime, 'uptime', plotUptime),
+                                (args.bulkReject, 'bulk-reject',
+                                 plotBulkReject)]:
+    if enabled:
+        stages.append(Stage(name, function, []))
+
+# Pages show the plots, and the upload includes both.
+plotStages = [stage.name for stage in stages]
+if args.markdownFiles is not None:
+    stages.append(Stage('markdown', renderMarkdown, plotStages))
+if args.uploadConfig is not None:
+    stages.append(Stage('upload', upload, [stage.name for stage in stages]))
+
+if run_stages(stages, args.stageJobs, log):
+    sys.exit(1)
@@ -0,0 +1,223 @@
+from __future__ import division
+import datetime
+import numpy
+from collections import deque
+from db import Database, errorTypes
+from sketches import cardinality, value_mean, value_sketch
+from size import SlidingIntersection, group_hours, \
+    SlidingSketchIntersection, group_sketches
+from time_utils import totalSeconds
+
+# Gathers what the network size RRD needs for each hour. Hours can be counted
+# in chunks independently of each other, so long ranges can be split across
+# worker processes, each with its own read connection.
+
+hour = datetime.timedelta(hours=1)
+
+
+def count_hours(db, start, end, approximate=False, medium_hours=24,
+                long_hours=168):
+    """
+    Return a list of dicts of what is needed to estimate network size for
+    each hour from start to end, in order:
+
+    * time: end of the hour.
+    * distinct: list of the distinct identifiers seen in the hour, and in
+      the intersections of the adjacent daily and weekly spans ending with it.
+    * samples: list of the samples for the same.
+    * datastore: mean datastore size over the weekly span ending with it,
+      excluding outliers.
+    * refused: number of refused probes in the hour.
+    * errors: list of the number of errors of each type in the hour.
+
+    Only hours which end by end are included. If approximate, identifiers
+    are counted and store sizes averaged from sketches rather than exactly.
+    """
+    # The earliest identifiers needed are those in the previous weekly span
+    # before the first estimate.
+    earliest = start + hour - 2 * long_hours * hour
+    count = int(totalSeconds(end - earliest) / 3600)
+    if approximate:
+        hourly = group_sketches(db.hourly_sketches(earliest, end),
+                                max(0, count))
+        Intersection = SlidingSketchIntersection
+    else:
+        hourly = group_hours(db.hourly_identifiers(earliest, end, hour),
+                             max(0, count))
+        Intersection = SlidingIntersection
+
+    weekly = Intersection(long_hours)
+    daily = Intersection(medium_hours)
+
+    hours = []
+    from_time = start
+    to_time = start + hour
+    if end < to_time:
+        return hours
+
+    # Mean datastore size over the weekly span ending with each hour, from
+    # sizes grouped by hour.
+    first = start - (long_hours - 1) * hour
+    value_hours = int(totalSeconds(end - first) / 3600)
+    if approximate:
+        datastore = window_means(
+            db.hourly_value_sketches('store_size', first, end), value_hours,
+            long_hours)
+    else:
+        datastore = window_exact_means(db.hourly_store_sizes(first, end),
+                                       value_hours, long_hours)
+    # Refused probes and errors in each hour to be estimated.
+    events = group_events(db.hourly_events(start, end),
+                          int(totalSeconds(end - start) / 3600))
+
+    # Fill the spans up to just before the first estimate.
+    for _ in xrange(2 * long_hours - 1):
+        occurrences = next(hourly)
+        weekly.push(occurrences)
+        daily.push(occurrences)
+
+    while end >= to_time:
+        # Identifiers seen from from_time to to_time.
+        instantaneous = next(hourly)
+        weekly.push(instantaneous)
+        daily.push(instantaneous)
+
+        if approximate:
+            samples = instantaneous.occurrences
+            distinct = cardinality(instantaneous.hyperloglog)
+        else:
+            samples = sum(instantaneous.itervalues())
+            distinct = len(instantaneous)
+
+        refused, errors = next(events)
+
+        hours.append({
+            'time': to_time,
+            'distinct': [distinct, daily.distinct, weekly.distinct],
+            'samples': [samples, daily.samples, weekly.samples],
+            'datastore': next(datastore),
+            'refused': refused,
+            'errors': errors,
+        })
+
+        from_time = to_time
+        to_time = from_time + hour
+
+    return hours
+
+
+def group_events(rows, count):
+    """
+    Take rows of (hour index, refused, errors) sorted by hour index and yield
+    a tuple of refused and errors for each of count hours in order, including
+    ones without any for hours with no rows.
+    """
+    rows = iter(rows)
+    row = next(rows, None)
+    for hour_index in xrange(count):
+        if row is not None and row[0] == hour_index:
+            yield row[1], row[2]
+            row = next(rows, None)
+        else:
+            yield 0, [0] * len(errorTypes)
+
+
+def window_means(rows, count, length):
+    """
+    Take rows of (hour index, value sketch) sorted by hour index for count
+    hours, and yield the mean excluding outliers over each span of length
+    hours, starting with the span of the first length hours.
+    """
+    rows = iter(rows)
+    row = next(rows, None)
+    window = deque()
+    merged = value_sketch([])
+    for hour_index in xrange(count):
+        if row is not None and row[0] == hour_index:
+            sketch = row[1]
+            row = next(rows, None)
+        else:
+            sketch = None
+
+        window.append(sketch)
+        if sketch is not None:
+            merged += sketch
+        if len(window) > length:
+            oldest = window.popleft()
+            if oldest is not None:
+                merged -= oldest
+
+        if len(window) == length:
+            yield value_mean(merged, exclude_outliers=True)
+
+
+def window_exact_means(rows, count, length):
+    """
+    Like window_means(), but with rows of (hour index, array of values), and
+    exact means excluding outliers as from mean_excluding_outliers().
+    """
+    rows = iter(rows)
+    row = next(rows, None)
+    window = deque()
+    for hour_index in xrange(count):
+        if row is not None and row[0] == hour_index:
+            values = row[1]
+            row = next(rows, None)
+        else:
+            values = numpy.empty(0)
+
+        window.append(values)
+        if len(window) > length:
+            window.popleft()
+
+        if len(window) == length:
+            yield mean_excluding_outliers(numpy.concatenate(window))
+
+
+def mean_excluding_outliers(values):
+    """
+    Return the mean of an array of values, excluding outliers, or NaN if
+    there are none. Outliers are those farther than 1.5 * interquartile
+    range from the median, as in Database.span_store_size().
+    """
+    if not len(values):
+        return float('NaN')
+
+    lower, median, upper = numpy.percentile(values, [25, 50, 75])
+    bound = 1.5 * (upper - lower)
+    inliers = values[(values > median - bound) & (values < median + bound)]
+    if not len(inliers):
+        return float('NaN')
+
+    return inliers.mean()
+
+
+def split_range(start, end, chunk_hours):
+    """
+    Return a list of (start, end) tuples covering the whole hours from start
+    to end in order, each at most chunk_hours long.
+    """
+    chunks = []
+    while start + hour <= end:
+        chunk_end = min(end, start + chunk_hours * hour)
+        chunks.append((start, chunk_end))
+        start = chunk_end
+    return chunks
+
+
+# Each worker process has its own connection.
+_db = None
+
+
+def start_worker(config):
+    """Pool initializer: open a read connection for this worker."""
+    global _db
+    _db = Database(config, read_only=True)
+
+
+def count_chunk(arguments):
+    """
+    Worker function: return count_hours() for a tuple of the remaining
+    arguments after db.
+    """
+    return count_hours(_db, *arguments)
@@ -23,13 +23,47 @@ for table in database.table_names:
     filename = prefix + table + suffix
     if os.path.exists(filename):
         source_file = open(filename)
+        # Columns are added at the end, so dumps from older versions have
+        # only the leading ones.
+        cur.execute("""
+        SELECT
+          column_name
+        FROM
+          information_schema.columns
+        WHERE
+          table_schema = 'public' AND table_name = %s
+        ORDER BY
+          ordinal_position
+        """, (table,))
+        columns = [x[0] for x in cur.fetchall()]
+        first_line = source_file.readline()
+        source_file.seek(0)
+        if first_line:
+            columns = columns[:len(first_line.split('\t'))]
         logging.info("Copying from %s to %s" % (filename, table))
-        cur.copy_from(source_file, table)
+        cur.copy_from(source_file, table, columns=columns)
         logging.info("Updating id sequence for %s" % table)
         update_id_sequence(cur, table)
 
+# Dumps from before schema version 7 have link lengths in their own table.
+filename = prefix + 'link_lengths' + suffix
+if os.path.exists(filename):
+    cur.execute("""
+    CREATE TEMPORARY TABLE
+      link_lengths(
+                   id       BIGINT NOT NULL,
+                   length   FLOAT NOT NULL,
+                   count_id INTEGER NOT NULL
+                  )""")
+    logging.info("Copying from %s to link_lengths" % filename)
+    cur.copy_from(open(filename), 'link_lengths')
+    database.maintenance.commit()
+    database.move_link_lengths('link_lengths')
+
 logging.warning("Copy complete. Recreating indexes.")
 database.create_indexes()
+logging.warning("Summarizing results by hour.")
+database.rebuild_derived()
 logging.warning("Analyzing.")
 cur.execute("ANALYZE")
 database.maintenance.commit()
@@ -47,33 +47,13 @@ for table in database.table_names:
     target_file = open(filename, 'w')
 
     # copy_expert() does not support parameter substitution; do it separately.
-    if table == 'link_lengths':
-        sql = cur.mogrify("""
-            COPY
-              (SELECT
-                id, length, count_id
-              FROM
-                (SELECT
-                  lengths.id, length, count_id, time
-                 FROM
-                   "link_lengths" lengths
-                 JOIN
-                   "peer_count" counts
-                 ON
-                   counts.id = lengths.count_id) _
-              WHERE
-                "time" between %(start)s AND %(end)s)
-            TO STDOUT""", {'start': start_date, 'end': up_to_date})
-        cur.copy_expert(sql, target_file)
-    else:
-        sql = cur.mogrify("""
-            COPY
-              (SELECT
-                *
-              FROM
-                "{0}"
-              WHERE
-                "time" BETWEEN %(start)s AND %(end)s)
-            TO STDOUT""".format(table), {'start': start_date,
-                                         'end': up_to_date})
-        cur.copy_expert(sql, target_file)
+    sql = cur.mogrify("""
+        COPY
+          (SELECT
+            *
+          FROM
+            "{0}"
+          WHERE
+            "time" BETWEEN %(start)s AND %(end)s)
+        TO STDOUT""".format(table), {'start': start_date, 'end': up_to_date})
+    cur.copy_expert(sql, target_file)
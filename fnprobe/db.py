@@ -1,7 +1,13 @@
+import datetime
 import logging
+import numpy
+import os
+import re
 from enum import Enum
+from itertools import chain
 import psycopg2
-from numpy import median, mean, percentile
+import psycopg2.tz
+import sketches
 
 
 # Current mapping between probe and error types. Used for storage (probe) and
@@ -58,16 +64,71 @@ def update_id_sequence(cur, table_name):
     """.format(table_name), {'table': table_name})
 
 
+# Tables which are computed from others rather than holding results as
+# reported.
+derived_tables = ['identifier_hourly', 'identifier_sketch', 'value_sketch']
+
+# Tables which hold a row per probe result.
+result_tables = ['bandwidth', 'build', 'error', 'identifier', 'location',
+                 'peer_count', 'refused', 'reject_stats', 'store_size',
+                 'uptime_48h', 'uptime_7d']
+
+# Queue types with bulk reject percentages in reject_stats.
+reject_types = ['bulk_request_chk',
+                'bulk_request_ssk',
+                'bulk_insert_chk',
+                'bulk_insert_ssk']
+
+
+# Indexes added to tables, as tuples of name, table, and the rest of the
+# definition. Results are stored roughly in order of time, so BRIN indexes,
+# which hold the range of times in each block of a table, narrow time spans
+# nearly as well as B-trees at a tiny fraction of the size and insert cost.
+# Spans of the tables analysis reads the most use B-trees on time including
+# the columns it reads instead, so that those columns can be read from the
+# index alone.
+indexes = [
+    ('bandwidth_time_brin', 'bandwidth', 'USING brin ("time")'),
+    ('build_time_brin', 'build', 'USING brin ("time")'),
+    ('error_time_brin', 'error', 'USING brin ("time")'),
+    ('identifier_identifier_time', 'identifier', '("identifier", "time")'),
+    ('identifier_time_covering', 'identifier',
+     '("time") INCLUDE ("identifier", "percent")'),
+    ('location_time_covering', 'location', '("time") INCLUDE ("location")'),
+    ('peer_count_time_covering', 'peer_count',
+     '("time") INCLUDE ("id", "peers")'),
+    ('refused_time_brin', 'refused', 'USING brin ("time")'),
+    ('reject_stats_time_brin', 'reject_stats', 'USING brin ("time")'),
+    ('store_size_time_covering', 'store_size', '("time") INCLUDE ("gib")'),
+    ('uptime_48h_time_brin', 'uptime_48h', 'USING brin ("time")'),
+    ('uptime_7d_time_brin', 'uptime_7d', 'USING brin ("time")'),
+]
+
+
+# Numeric result columns summarized by hour in value_sketch, by table.
+sketched_values = {
+    'bandwidth': 'kib',
+    'store_size': 'gib',
+    'uptime_48h': 'percent',
+    'uptime_7d': 'percent',
+}
+
+
 class Database:
     """Handles database connection, initialization, and analysis queries."""
 
-    def __init__(self, config):
+    def __init__(self, config, read_only=False):
         """
         Initialize the database if it does not already exist. If it already
         exists and is not the latest version, upgrade it.
 
         Exposes maintenance, record addition, and reading connections as
-        maintenance, add, and read respectively.
+        maintenance, add, and read respectively. The keyword arguments used
+        to open the record addition connection are add_parameters.
+
+        If read_only is True, only the reading connection is opened, and the
+        database is assumed to be set up already. This is for additional
+        connections for analysis, such as from worker processes.
 
         :type config: dict contains at least database, maintenance_user,
         read_user, add_user.
@@ -75,6 +136,8 @@ class Database:
         maintenance_pass, read_pass, and add_pass are also recognized. Other
         parameters are passed to the database as keyword arguments.
         """
+        # The caller's config is left as given so that it can be reused.
+        config = dict(config)
 
         auth = {}
         # Move manually used parameters into expected config so they are not
@@ -93,19 +156,29 @@ class Database:
             if parameter in config:
                 del config[parameter]
 
-        self.maintenance = psycopg2.connect(user=auth['maintenance_user'],
-                                            password=auth['maintenance_pass'],
-                                            **config)
         self.read = psycopg2.connect(user=auth['read_user'],
                                      password=auth['read_pass'], **config)
-        self.add = psycopg2.connect(user=auth['add_user'],
-                                    password=auth['add_pass'], **config)
 
         # Prevent the read connection from holding open a transaction for
         # long. Another option would be to manually commit after each group
         # of queries.
         self.read.autocommit = True
 
+        if read_only:
+            self.table_names = self.list_tables()
+            return
+
+        self.maintenance = psycopg2.connect(user=auth['maintenance_user'],
+                                            password=auth['maintenance_pass'],
+                                            **config)
+        self.add = psycopg2.connect(user=auth['add_user'],
+                                    password=auth['add_pass'], **config)
+
+        # Keyword arguments for opening further record addition connections,
+        # such as from a connection pool.
+        self.add_parameters = dict(config, user=auth['add_user'],
+                                   password=auth['add_pass'])
+
         cur = self.maintenance.cursor()
         try:
             cur.execute("""
@@ -116,44 +189,35 @@ class Database:
             version = cur.fetchone()[0]
             self.maintenance.commit()
 
-            # The database has already been set up. Upgrade to the latest
-            # version if necessary.
+            # The database has already been set up.
             logging.info("Found version {0}.".format(version))
-            self.upgrade(version, config)
-
-            self.table_names = self.list_tables()
         except psycopg2.ProgrammingError, e:
             logging.debug("Got '{0}' when querying version.".format(e.pgerror))
             # If there are no tables in this database, it is new, so set up the
-            # latest version.
+            # first version.
             self.maintenance.commit()
             self.create_new()
-
-            self.table_names = self.list_tables(cur)
+            version = 0
 
             # Grant permissions to the newly created tables.
-            for table_name in self.table_names:
+            for table_name in self.list_tables(cur):
                 self.set_privileges(auth, table_name)
 
-            # PostgreSQL's INSERT RETURNING requires SELECT. This is used in
-            # probe.py when inserting peer_count results.
-            # http://www.postgresql.org/docs/current/static/sql-insert.html
-            cur.execute("""
-            GRANT
-              SELECT(id)
-            ON TABLE
-              "peer_count"
-            TO
-              "{0}"
-            """.format(auth['add_user']))
-
             self.maintenance.commit()
 
+        # Upgrade to the latest version if necessary.
+        self.upgrade(version, auth)
+
+        # Keep partitions ahead of the results being added.
+        self.create_partitions()
+
+        self.table_names = self.list_tables()
+
     def set_privileges(self, auth, table_name):
         """
         Sets default privileges for the table:
         * read_user gets SELECT
-        * add_user gets INSERT; UPDATE for the "id" sequence.
+        * add_user gets INSERT; UPDATE for the "id" sequence if there is one.
         """
         cur = self.maintenance.cursor()
 
@@ -175,21 +239,29 @@ class Database:
           "{1}"
         """.format(table_name, auth['add_user']))
 
+        # Not all tables have an "id" column, and pg_get_serial_sequence()
+        # fails on those which do not.
         cur.execute("""
                 SELECT
-                  pg_get_serial_sequence(%(table)s, 'id')
+                  pg_get_serial_sequence(table_name, column_name)
+                FROM
+                  information_schema.columns
+                WHERE
+                  table_name = %(table)s AND column_name = 'id'
                 """, {'table': table_name})
-        sequence = cur.fetchone()[0]
-        # sequence is qualified with a schema name and quoting the entire
-        # thing makes it invalid.
-        cur.execute("""
-            GRANT
-              UPDATE
-            ON SEQUENCE
-              {0}
-            TO
-              "{1}"
-            """.format(sequence, auth['add_user']))
+        row = cur.fetchone()
+        sequence = row and row[0]
+        if sequence is not None:
+            # sequence is qualified with a schema name and quoting the entire
+            # thing makes it invalid.
+            cur.execute("""
+                GRANT
+                  UPDATE
+                ON SEQUENCE
+                  {0}
+                TO
+                  "{1}"
+                """.format(sequence, auth['add_user']))
 
         self.maintenance.commit()
 
@@ -345,69 +417,17 @@ class Database:
         logging.warning("Table setup complete.")
 
     def create_indexes(self):
+        """
+        Create the indexes in indexes which do not exist yet.
+        """
         cur = self.maintenance.cursor()
 
-        cur.execute("""
-        CREATE INDEX
-          bandwidth_time_index
-        ON
-          bandwidth(time)""")
-        cur.execute("""
-        CREATE INDEX
-          build_time_index
-        ON
-          build(time)""")
-        cur.execute("""
-        CREATE INDEX
-          identifier_identifier_time
-        ON
-          identifier(identifier, time)""")
-        cur.execute("""
-        CREATE INDEX
-          identifier_time_identifier
-        ON
-          identifier(time, identifier)""")
-        cur.execute("""
-        CREATE INDEX
-          peer_count_time_index
-        ON
-          peer_count(time)
-        """)
-        cur.execute("""
-        CREATE INDEX
-          location_time_index
-        ON
-          location(time)""")
-        cur.execute("""
-        CREATE INDEX
-          store_size_time_index
-        ON
-          store_size(time)""")
-        cur.execute("""
-        CREATE INDEX
-          reject_stats_time_index
-        ON
-          reject_stats(time)""")
-        cur.execute("""
-        CREATE INDEX
-          uptime_48h_time_index
-        ON
-          uptime_48h(time)""")
-        cur.execute("""
-        CREATE INDEX
-          uptime_7d_time_index
-        ON
-          uptime_7d(time)""")
-        cur.execute("""
-        CREATE INDEX
-          error_time_index
-        ON
-          error(time)""")
-        cur.execute("""
-        CREATE INDEX
-          refused_time_index
-        ON
-          refused(time)""")
+        for name, table, definition in indexes:
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS
+              "{0}"
+            ON
+              "{1}" {2}""".format(name, table, definition))
 
         self.maintenance.commit()
 
@@ -418,21 +438,16 @@ class Database:
         """
         cur = self.maintenance.cursor()
 
-        for index in ['bandwidth_time_index', 'build_time_index',
-                      'identifier_identifier_time',
-                      'identifier_time_identifier', 'peer_count_time_index',
-                      'location_time_index', 'store_size_time_index',
-                      'reject_stats_time_index', 'uptime_48h_time_index',
-                      'uptime_7d_time_index', 'error_time_index',
-                      'refused_time_index']:
-            cur.execute("""DROP INDEX IF EXISTS {0}""".format(index))
+        for name, _, _ in indexes:
+            cur.execute('DROP INDEX IF EXISTS "{0}"'.format(name))
 
         self.maintenance.commit()
 
     def list_tables(self, cur=None):
         """
         Return a list of the names of public tables in the database (excluding
-        "meta") in order usable for importing dumps.
+        "meta" and those in derived_tables) in order usable for importing
+        dumps.
 
         Can take a cursor to use, but defaults to read.
         """
@@ -440,7 +455,8 @@ class Database:
             cur = self.read.cursor()
 
         # Ignore meta - it is just a version number. It need not be dumped or
-        # hold probe results or be analyzed.
+        # hold probe results or be analyzed. Derived tables can be rebuilt
+        # from the others.
         cur.execute("""
         SELECT
           table_name
@@ -448,29 +464,767 @@ class Database:
           information_schema.tables
         WHERE
           table_schema = 'public' AND table_name != 'meta'
+          AND table_name NOT IN %s
+          -- Partitions are reached through the table they are part of.
+          AND NOT (SELECT
+                     relispartition
+                   FROM
+                     pg_class
+                   WHERE
+                     oid = ('public.' || quote_ident(table_name))::regclass)
         ORDER BY
           table_name
-        """)
+        """, (tuple(derived_tables),))
 
         # Each element will be a singleton tuple.
         tables = [x[0] for x in cur.fetchall()]
 
-        # peer_count comes after link_lengths alphabetically, but link_lengths
-        # REFERENCES peer_count, so peer_count must come first when importing.
-        peer_count_index = tables.index('peer_count')
-        link_lengths_index = tables.index('link_lengths')
+        # Before version 7, peer_count comes after link_lengths
+        # alphabetically, but link_lengths REFERENCES peer_count, so
+        # peer_count must come first when importing.
+        if 'link_lengths' in tables:
+            peer_count_index = tables.index('peer_count')
+            link_lengths_index = tables.index('link_lengths')
 
-        assert peer_count_index > link_lengths_index
+            assert peer_count_index > link_lengths_index
 
-        tables[peer_count_index], tables[link_lengths_index] = \
-            tables[link_lengths_index], tables[peer_count_index]
+            tables[peer_count_index], tables[link_lengths_index] = \
+                tables[link_lengths_index], tables[peer_count_index]
 
         return tables
 
-    def upgrade(self, version, config):
-        # The user names (in config) will be needed to modify permissions as
-        # part of upgrades.
-        pass
+    def upgrade(self, version, auth):
+        """
+        Upgrade the schema from the given version to the latest one, one
+        version at a time. Each upgrade is committed along with the version
+        it results in.
+
+        :type auth: dict of user names, for modifying permissions as part of
+        upgrades.
+        """
+        # Element n upgrades from version n to version n + 1.
+        upgrades = [self.add_node_column, self.add_identifier_rollup,
+                    self.add_identifier_sketch, self.add_value_sketch,
+                    self.partition_by_month, self.index_brin_covering,
+                    self.fold_link_lengths]
+
+        for upgrade_version in range(version, len(upgrades)):
+            logging.warning("Upgrading schema from version {0} to {1}.".format(
+                upgrade_version, upgrade_version + 1))
+            upgrades[upgrade_version](auth)
+
+            cur = self.maintenance.cursor()
+            cur.execute("""
+            UPDATE
+              meta
+            SET
+              schema_version = %s
+            """, (upgrade_version + 1,))
+            self.maintenance.commit()
+
+    def add_node_column(self, auth):
+        """
+        Version 1: Record the name of the node which gathered each result.
+        Results from before it was recorded have none.
+        """
+        cur = self.maintenance.cursor()
+        for table in result_tables:
+            cur.execute("""
+            ALTER TABLE
+              "{0}"
+            ADD COLUMN
+              node TEXT
+            """.format(table))
+
+    def add_identifier_rollup(self, auth):
+        """
+        Version 2: Add identifier_hourly, which holds the number of times each
+        identifier was seen in each hour. probe.py updates it along with
+        identifier, so add_user can also update it.
+        """
+        cur = self.maintenance.cursor()
+        cur.execute("""
+        CREATE TABLE
+          identifier_hourly(
+                            hour       TIMESTAMP WITH TIME ZONE NOT NULL,
+                            identifier BIGINT NOT NULL,
+                            count      INTEGER NOT NULL,
+                            PRIMARY KEY (hour, identifier)
+                           )""")
+
+        self.set_privileges(auth, 'identifier_hourly')
+        # Adding to an existing count reads it.
+        cur.execute("""
+        GRANT
+          SELECT, UPDATE
+        ON TABLE
+          identifier_hourly
+        TO
+          "{0}"
+        """.format(auth['add_user']))
+
+        logging.warning("Adding up existing identifiers by hour.")
+        self.count_identifiers()
+
+    def add_identifier_sketch(self, auth):
+        """
+        Version 3: Add identifier_sketch, which holds a HyperLogLog sketch
+        and a count sketch of the identifiers seen in each hour, and the
+        number of times any were seen. See fnprobe.sketches. probe.py updates
+        it along with identifier, so add_user can also update it.
+        """
+        cur = self.maintenance.cursor()
+        cur.execute("""
+        CREATE TABLE
+          identifier_sketch(
+                            hour         TIMESTAMP WITH TIME ZONE PRIMARY KEY,
+                            occurrences  INTEGER NOT NULL,
+                            hyperloglog  BYTEA NOT NULL,
+                            count_sketch BYTEA NOT NULL
+                           )""")
+
+        self.set_privileges(auth, 'identifier_sketch')
+        # Merging into an existing sketch reads and locks it.
+        cur.execute("""
+        GRANT
+          SELECT, UPDATE
+        ON TABLE
+          identifier_sketch
+        TO
+          "{0}"
+        """.format(auth['add_user']))
+
+        logging.warning("Sketching existing identifiers by hour.")
+        self.sketch_identifiers()
+
+    def add_value_sketch(self, auth):
+        """
+        Version 4: Add value_sketch, which holds a sketch of the values of
+        each table in sketched_values for each hour. See
+        fnprobe.sketches.value_sketch(). probe.py updates it along with those
+        tables, so add_user can also update it.
+        """
+        cur = self.maintenance.cursor()
+        cur.execute("""
+        CREATE TABLE
+          value_sketch(
+                       hour   TIMESTAMP WITH TIME ZONE NOT NULL,
+                       source TEXT NOT NULL,
+                       sketch BYTEA NOT NULL,
+                       PRIMARY KEY (hour, source)
+                      )""")
+
+        self.set_privileges(auth, 'value_sketch')
+        # Merging into an existing sketch reads and locks it.
+        cur.execute("""
+        GRANT
+          SELECT, UPDATE
+        ON TABLE
+          value_sketch
+        TO
+          "{0}"
+        """.format(auth['add_user']))
+
+        logging.warning("Sketching existing values by hour.")
+        self.sketch_values()
+
+    def partition_by_month(self, auth):
+        """
+        Version 5: Partition result tables by month of time, so that queries
+        over spans of time only read the months they cover, and old months
+        can be dropped whole. Each table keeps a default partition for
+        results outside the months which have their own.
+
+        Primary keys of partitioned tables must include time, so id alone
+        is no longer unique as far as the database knows, and link_lengths
+        can no longer reference peer_count. link_lengths has no time of its
+        own, so it is left as it is.
+
+        Each table is converted and committed in its own transaction, and
+        tables which are already partitioned are skipped, so if this is
+        interrupted it carries on where it left off.
+        """
+        cur = self.maintenance.cursor()
+
+        cur.execute("""
+        SELECT
+          relname
+        FROM
+          pg_partitioned_table
+          JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid
+        WHERE
+          relname IN %s
+        """, (tuple(result_tables),))
+        partitioned = set(row[0] for row in cur.fetchall())
+
+        cur.execute("""
+        SELECT
+          conname
+        FROM
+          pg_constraint
+        WHERE
+          conrelid = 'link_lengths'::regclass AND contype = 'f'
+        """)
+        for constraint, in cur.fetchall():
+            cur.execute("""
+            ALTER TABLE
+              link_lengths
+            DROP CONSTRAINT
+              "{0}"
+            """.format(constraint))
+
+        # Index names must not clash with those on the new tables.
+        self.drop_indexes()
+
+        cur.execute("""
+        SELECT
+          min(time)
+        FROM
+          ({0}) _
+        """.format(' UNION ALL '.join(
+            'SELECT min(time) AS time FROM "{0}"'.format(table)
+            for table in result_tables)))
+        earliest = cur.fetchone()[0]
+
+        for table in result_tables:
+            if table in partitioned:
+                logging.warning("{0} is already partitioned.".format(table))
+                continue
+
+            logging.warning("Partitioning {0}.".format(table))
+            old = table + '_unpartitioned'
+            cur.execute("""
+            SELECT
+              pg_get_serial_sequence(%s, 'id')
+            """, (table,))
+            sequence = cur.fetchone()[0]
+
+            cur.execute("""
+            ALTER TABLE
+              "{0}"
+            RENAME TO
+              "{1}"
+            """.format(table, old))
+            cur.execute("""
+            ALTER TABLE
+              "{0}"
+            DROP CONSTRAINT
+              "{1}_pkey"
+            """.format(old, table))
+
+            # The id default still draws from the same sequence.
+            cur.execute("""
+            CREATE TABLE
+              "{0}"(
+                    LIKE "{1}" INCLUDING DEFAULTS,
+                    PRIMARY KEY (id, time)
+                   )
+            PARTITION BY RANGE (time)
+            """.format(table, old))
+            cur.execute("""
+            CREATE TABLE
+              "{0}_default"
+            PARTITION OF
+              "{0}"
+            DEFAULT
+            """.format(table))
+            self.create_partitions([table], earliest, commit=False)
+
+            cur.execute("""
+            INSERT INTO
+              "{0}"
+            SELECT
+              *
+            FROM
+              "{1}"
+            """.format(table, old))
+
+            # sequence is qualified with a schema name and quoting the entire
+            # thing makes it invalid.
+            cur.execute("""
+            ALTER SEQUENCE
+              {0}
+            OWNED BY
+              "{1}".id
+            """.format(sequence, table))
+            cur.execute("""
+            DROP TABLE
+              "{0}"
+            """.format(old))
+
+            self.maintenance.commit()
+
+        # Granting again is harmless, and covers a table committed just
+        # before an interruption.
+        for table in result_tables:
+            self.set_privileges(auth, table)
+
+        self.create_indexes()
+
+    def index_brin_covering(self, auth):
+        """
+        Version 6: Replace B-tree indexes on time with BRIN indexes, or with
+        B-trees which include the columns analysis reads, as described with
+        indexes.
+
+        Index-only scans rely on the visibility map, which autovacuum only
+        keeps up to date for tables that are just inserted into as of
+        PostgreSQL 13.
+        """
+        cur = self.maintenance.cursor()
+        for table in result_tables:
+            cur.execute("""
+            DROP INDEX IF EXISTS
+              "{0}_time_index"
+            """.format(table))
+        cur.execute("""
+        DROP INDEX IF EXISTS
+          identifier_time_identifier
+        """)
+
+        logging.warning("Creating indexes.")
+        self.create_indexes()
+
+    def fold_link_lengths(self, auth):
+        """
+        Version 7: Store the link lengths of each peer count as an array on
+        its peer_count row instead of as a link_lengths row per length, which
+        took several times the space of the length itself and had to be
+        joined back to peer_count. Lengths are stored as REAL, which is
+        plenty for differences between locations.
+
+        Lengths are moved in batches which are each committed, so if this is
+        interrupted it carries on where it left off.
+        """
+        cur = self.maintenance.cursor()
+        # An empty array default does not rewrite the table.
+        cur.execute("""
+        ALTER TABLE
+          peer_count
+        ADD COLUMN IF NOT EXISTS
+          lengths REAL[] NOT NULL DEFAULT '{}'
+        """)
+        self.maintenance.commit()
+
+        self.move_link_lengths('link_lengths')
+
+        cur.execute("""
+        DROP TABLE
+          link_lengths
+        """)
+
+    def move_link_lengths(self, table, batch_size=10000):
+        """
+        Append the lengths in a table of id, length, and count_id rows, laid
+        out like link_lengths before version 7, to the lengths of the
+        peer_count rows they belong to, in order of id. Moved rows are
+        deleted, in batches of batch_size peer count ids, each committed.
+        Lengths without a peer count are dropped.
+        """
+        cur = self.maintenance.cursor()
+        # Each batch finds its rows by count_id.
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS
+          "{0}_count_id"
+        ON
+          "{0}"("count_id") INCLUDE ("length")
+        """.format(table))
+        cur.execute("""
+        SELECT
+          min(count_id), max(count_id)
+        FROM
+          "{0}"
+        """.format(table))
+        first, last = cur.fetchone()
+        self.maintenance.commit()
+        if first is None:
+            return
+
+        logging.warning("Moving link lengths from {0} to peer_count.".format(
+            table))
+        for low in xrange(first, last + 1, batch_size):
+            cur.execute("""
+            WITH moved AS (
+              DELETE FROM
+                "{0}"
+              WHERE
+                count_id >= %(low)s AND count_id < %(high)s
+              RETURNING
+                id, length, count_id
+            )
+            UPDATE
+              peer_count
+            SET
+              lengths = peer_count.lengths || grouped.lengths
+            FROM
+              (SELECT
+                 count_id, array_agg(length::REAL ORDER BY id) AS lengths
+               FROM
+                 moved
+               GROUP BY
+                 count_id
+              ) grouped
+            WHERE
+              peer_count.id = grouped.count_id
+            """.format(table), {'low': low, 'high': low + batch_size})
+            self.maintenance.commit()
+            logging.info("Moved link lengths of peer counts up to {0} of "
+                         "{1}.".format(min(low + batch_size - 1, last), last))
+
+    def create_partitions(self, tables=None, start=None, months_ahead=3,
+                          commit=True):
+        """
+        Create monthly partitions of the given tables, or all result tables,
+        which do not yet exist from the month containing start, or the
+        current month, to months_ahead months after the current one. Month
+        boundaries are in UTC.
+
+        A partition cannot be created for a month the default partition
+        already has results in. That is logged and the month is left in the
+        default partition.
+        """
+        if tables is None:
+            tables = result_tables
+
+        now = datetime.datetime.utcnow()
+        if start is None:
+            start = now
+        else:
+            start = start.astimezone(psycopg2.tz.FixedOffsetTimezone(0))
+        month = start.year * 12 + start.month - 1
+        last = now.year * 12 + now.month - 1 + months_ahead
+
+        cur = self.maintenance.cursor()
+        while month <= last:
+            year, month_index = divmod(month, 12)
+            next_year, next_month_index = divmod(month + 1, 12)
+            for table in tables:
+                partition = '{0}_y{1:04d}m{2:02d}'.format(table, year,
+                                                          month_index + 1)
+                cur.execute("SAVEPOINT partition")
+                try:
+                    cur.execute("""
+                    CREATE TABLE IF NOT EXISTS
+                      "{0}"
+                    PARTITION OF
+                      "{1}"
+                    FOR VALUES
+                      FROM ('{2:04d}-{3:02d}-01 00:00+00')
+                      TO ('{4:04d}-{5:02d}-01 00:00+00')
+                    """.format(partition, table, year, month_index + 1,
+                               next_year, next_month_index + 1))
+                except psycopg2.Error, e:
+                    logging.warning("Could not create {0}: {1}".format(
+                        partition, e.pgerror))
+                    cur.execute("ROLLBACK TO SAVEPOINT partition")
+                else:
+                    cur.execute("RELEASE SAVEPOINT partition")
+            month += 1
+
+        if commit:
+            self.maintenance.commit()
+
+    def expired_partitions(self, cutoff):
+        """
+        Return a list of tuples of table, partition, and month start of the
+        monthly partitions of result tables which end at or before cutoff,
+        ordered by month. Only partitions named as create_partitions() names
+        them are considered.
+        """
+        cur = self.maintenance.cursor()
+        cur.execute("""
+        SELECT
+          parent.relname, child.relname
+        FROM
+          pg_inherits
+          JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+          JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE
+          parent.relname IN %s
+        """, (tuple(result_tables),))
+        rows = cur.fetchall()
+        self.maintenance.commit()
+
+        utc = psycopg2.tz.FixedOffsetTimezone(0)
+        expired = []
+        for table, partition in rows:
+            match = re.match(r'^{0}_y(\d{{4}})m(\d{{2}})$'.format(table),
+                             partition)
+            if not match:
+                continue
+            year, month = int(match.group(1)), int(match.group(2))
+            start = datetime.datetime(year, month, 1, tzinfo=utc)
+            next_year, next_month_index = divmod(year * 12 + month, 12)
+            end = datetime.datetime(next_year, next_month_index + 1, 1,
+                                    tzinfo=utc)
+            if end <= cutoff:
+                expired.append((table, partition, start))
+
+        expired.sort(key=lambda row: (row[2], row[0]))
+        return expired
+
+    def drop_results_before(self, cutoff, archive_dir=None):
+        """
+        Remove results from before cutoff. Monthly partitions which end by
+        cutoff are dropped whole, and earlier results in default partitions
+        are deleted.
+
+        If archive_dir is given, results are copied there before they are
+        removed, in files named with the month (or "before-" and the date of
+        cutoff for default partitions) followed by "-", the table name, and
+        ".sql". These can be imported with copy_from.py. Archives are written
+        under a temporary name and renamed once complete, so an existing
+        archive is from an earlier run which was interrupted before removing
+        what it holds. It is kept as it is, and the results removed.
+
+        Each partition is removed in its own transaction.
+        """
+        cur = self.maintenance.cursor()
+
+        def archive(name, query, parameters=None):
+            if archive_dir is None:
+                return
+            path = os.path.join(archive_dir, name)
+            if os.path.exists(path):
+                logging.warning("Archive {0} already exists; not writing it "
+                                "again.".format(path))
+                return
+            logging.info("Archiving to {0}.".format(path))
+            with open(path + '.part', 'w') as output:
+                cur.copy_expert(cur.mogrify("COPY ({0}) TO STDOUT".format(
+                    query), parameters), output)
+                output.flush()
+                os.fsync(output.fileno())
+            os.rename(path + '.part', path)
+
+        for table, partition, start in self.expired_partitions(cutoff):
+            month = start.strftime('%Y-%m')
+            archive('{0}-{1}.sql'.format(month, table),
+                    'SELECT * FROM "{0}"'.format(partition))
+
+            logging.warning("Dropping {0}.".format(partition))
+            cur.execute('DROP TABLE "{0}"'.format(partition))
+            self.maintenance.commit()
+
+        # Results from before any monthly partition existed, or in months
+        # which could not have one created.
+        before = 'before-{0}'.format(cutoff.strftime('%Y-%m-%d'))
+        for table in result_tables:
+            default = '{0}_default'.format(table)
+            condition = 'time < %(cutoff)s'
+            cur.execute("""
+            SELECT
+              EXISTS(SELECT 1 FROM "{0}" WHERE {1})
+            """.format(default, condition), {'cutoff': cutoff})
+            if not cur.fetchone()[0]:
+                continue
+
+            archive('{0}-{1}.sql'.format(before, table),
+                    'SELECT * FROM "{0}" WHERE {1}'.format(default, condition),
+                    {'cutoff': cutoff})
+
+            cur.execute("""
+            DELETE FROM
+              "{0}"
+            WHERE
+              {1}
+            """.format(default, condition), {'cutoff': cutoff})
+            if cur.rowcount:
+                logging.warning("Deleted {0} rows from {1}.".format(
+                    cur.rowcount, default))
+            self.maintenance.commit()
+
+    def expired_default_rows(self, cutoff):
+        """
+        Return a list of tuples of default partition and the number of
+        results in it from before cutoff, for those which have any. These are
+        the rows drop_results_before() deletes.
+        """
+        cur = self.maintenance.cursor()
+        expired = []
+        for table in result_tables:
+            default = '{0}_default'.format(table)
+            cur.execute("""
+            SELECT
+              count(*)
+            FROM
+              "{0}"
+            WHERE
+              time < %s
+            """.format(default), (cutoff,))
+            count = cur.fetchone()[0]
+            if count:
+                expired.append((default, count))
+        self.maintenance.commit()
+
+        return expired
+
+    def expired_derived_rows(self, cutoff):
+        """
+        Return a list of tuples of derived table and the number of its rows
+        from hours before cutoff. These are the rows drop_derived_before()
+        deletes.
+        """
+        cur = self.maintenance.cursor()
+        expired = []
+        for table in derived_tables:
+            cur.execute("""
+            SELECT
+              count(*)
+            FROM
+              "{0}"
+            WHERE
+              hour < %s
+            """.format(table), (cutoff,))
+            expired.append((table, cur.fetchone()[0]))
+        self.maintenance.commit()
+
+        return expired
+
+    def drop_derived_before(self, cutoff):
+        """
+        Delete the hours in derived tables from before cutoff.
+        """
+        cur = self.maintenance.cursor()
+        for table in derived_tables:
+            cur.execute("""
+            DELETE FROM
+              "{0}"
+            WHERE
+              hour < %s
+            """.format(table), (cutoff,))
+            logging.warning("Deleted {0} rows from {1}.".format(cur.rowcount,
+                                                               table))
+            self.maintenance.commit()
+
+    def rebuild_derived(self, start=None, end=None):
+        """
+        Recompute all derived tables for the hours from start to end, or all
+        hours if they are not given. This is needed after results are added
+        other than by probe.py, such as when importing dumps.
+        """
+        self.rollup_identifiers(start, end)
+        self.sketch_values(start, end)
+
+    def sketch_values(self, start=None, end=None):
+        """
+        Rebuild value_sketch from the tables in sketched_values for the hours
+        from start to end, or all hours if they are not given.
+        """
+        write = self.maintenance.cursor()
+        for table, column in sorted(sketched_values.iteritems()):
+            # Named cursors are otherwise closed at the end of the
+            # transaction, which the updates commit.
+            read = self.maintenance.cursor('sketch_values', withhold=True)
+            try:
+                read.execute("""
+                SELECT
+                  to_timestamp(floor(extract(epoch FROM "time") / 3600) *
+                               3600) AS hour,
+                  array_agg("{0}")
+                FROM
+                  "{1}"
+                WHERE
+                  (%(start)s IS NULL OR "time" >= %(start)s)
+                  AND (%(end)s IS NULL OR "time" < %(end)s)
+                GROUP BY
+                  hour
+                """.format(column, table), {'start': start, 'end': end})
+                self.maintenance.commit()
+
+                for hour, values in read:
+                    write.execute("""
+                    INSERT INTO
+                      value_sketch(hour, source, sketch)
+                      values (%s, %s, %s)
+                    ON CONFLICT (hour, source) DO UPDATE
+                      SET sketch = EXCLUDED.sketch
+                    """, (hour, table, psycopg2.Binary(
+                        sketches.to_bytes(sketches.value_sketch(values)))))
+                    self.maintenance.commit()
+            finally:
+                read.close()
+                self.maintenance.commit()
+
+    def rollup_identifiers(self, start=None, end=None):
+        """
+        Recompute identifier_hourly and identifier_sketch from identifier for
+        the hours from start to end, or all hours if they are not given. This
+        is needed after results are added other than by probe.py, such as when
+        importing dumps.
+
+        start and end should be on hour boundaries; an hour partly outside
+        them will be counted from only the part inside.
+        """
+        self.count_identifiers(start, end)
+        self.sketch_identifiers(start, end)
+
+    def count_identifiers(self, start=None, end=None):
+        """
+        Recount identifier_hourly from identifier for the hours from start to
+        end, or all hours if they are not given.
+        """
+        cur = self.maintenance.cursor()
+        cur.execute("""
+        INSERT INTO
+          identifier_hourly(hour, identifier, count)
+        SELECT
+          to_timestamp(floor(extract(epoch FROM "time") / 3600) * 3600) AS hour,
+          "identifier", count(*)
+        FROM
+          "identifier"
+        WHERE
+          (%(start)s IS NULL OR "time" >= %(start)s)
+          AND (%(end)s IS NULL OR "time" < %(end)s)
+        GROUP BY
+          hour, "identifier"
+        ON CONFLICT (hour, identifier) DO UPDATE
+          SET count = EXCLUDED.count
+        """, {'start': start, 'end': end})
+        self.maintenance.commit()
+
+    def sketch_identifiers(self, start=None, end=None):
+        """
+        Rebuild identifier_sketch from identifier_hourly for the hours from
+        start to end, or all hours if they are not given.
+        """
+        # Named cursors are otherwise closed at the end of the transaction,
+        # which the updates commit.
+        read = self.maintenance.cursor('sketch_identifiers', withhold=True)
+        write = self.maintenance.cursor()
+        try:
+            read.execute("""
+            SELECT
+              "hour", array_agg("identifier"), array_agg("count")
+            FROM
+              "identifier_hourly"
+            WHERE
+              (%(start)s IS NULL OR "hour" >= %(start)s)
+              AND (%(end)s IS NULL OR "hour" < %(end)s)
+            GROUP BY
+              "hour"
+            """, {'start': start, 'end': end})
+            self.maintenance.commit()
+
+            for hour, identifiers, counts in read:
+                hyperloglog = sketches.hyperloglog(identifiers)
+                count_sketch = sketches.count_sketch(identifiers, counts)
+                write.execute("""
+                INSERT INTO
+                  identifier_sketch(hour, occurrences, hyperloglog,
+                                    count_sketch)
+                  values (%s, %s, %s, %s)
+                ON CONFLICT (hour) DO UPDATE
+                  SET occurrences = EXCLUDED.occurrences,
+                      hyperloglog = EXCLUDED.hyperloglog,
+                      count_sketch = EXCLUDED.count_sketch
+                """, (hour, sum(counts),
+                      psycopg2.Binary(sketches.to_bytes(hyperloglog)),
+                      psycopg2.Binary(sketches.to_bytes(count_sketch))))
+                self.maintenance.commit()
+        finally:
+            read.close()
+            self.maintenance.commit()
 
     def earliest_result(self):
         """
@@ -481,9 +1235,6 @@ class Database:
         overall_earliest = None
 
         for table in self.table_names:
-            if table == 'link_lengths':
-                # Link lengths only has time in association with peer_count.
-                continue
             cur.execute("""
             SELECT
               min(time)
@@ -521,6 +1272,158 @@ class Database:
                   'latest': latest})
         return cur.fetchone()
 
+    def hourly_identifiers(self, start, end, period):
+        """
+        Yield a tuple of the period index, identifier, and number of
+        occurrences for each identifier seen in each period between start and
+        end, ordered by period. The period index counts periods since start,
+        from zero. Each period includes its start and excludes its end.
+
+        :type period: timedelta length of a period.
+
+        This is read from identifier_hourly, so start and period must both be
+        whole hours. (An hour is counted in the period it starts in.) Results
+        are streamed from a server-side cursor rather than all held in memory
+        at once.
+        """
+        # Named cursors are otherwise closed at the end of the transaction,
+        # which with autocommit is immediately.
+        cur = self.read.cursor('hourly_identifiers', withhold=True)
+        try:
+            cur.execute("""
+                SELECT
+                  floor(extract(epoch FROM "hour" - %(start)s) /
+                        extract(epoch FROM %(period)s))::INTEGER AS period,
+                  "identifier", sum("count")::INTEGER
+                FROM
+                  "identifier_hourly"
+                WHERE
+                  "hour" >= %(start)s AND "hour" < %(end)s
+                GROUP BY
+                  period, "identifier"
+                ORDER BY
+                  period
+                """, {'start': start, 'end': end, 'period': period})
+            for row in cur:
+                yield row
+        finally:
+            cur.close()
+
+    def hourly_sketches(self, start, end):
+        """
+        Yield a tuple of the hour index, number of identifiers seen, and the
+        HyperLogLog and count sketches of them for each hour between start
+        and end which has any, ordered by hour. The hour index counts hours
+        since start, from zero. start must be on an hour boundary.
+        """
+        cur = self.read.cursor('hourly_sketches', withhold=True)
+        try:
+            cur.execute("""
+                SELECT
+                  floor(extract(epoch FROM "hour" - %(start)s) / 3600)::INTEGER,
+                  "occurrences", "hyperloglog", "count_sketch"
+                FROM
+                  "identifier_sketch"
+                WHERE
+                  "hour" >= %(start)s AND "hour" < %(end)s
+                ORDER BY
+                  "hour"
+                """, {'start': start, 'end': end})
+            for index, occurrences, hyperloglog, count_sketch in cur:
+                yield (index, occurrences,
+                       sketches.hyperloglog_from_bytes(hyperloglog),
+                       sketches.count_sketch_from_bytes(count_sketch))
+        finally:
+            cur.close()
+
+    def hourly_events(self, start, end):
+        """
+        Yield a tuple of the hour index, number of refused probes, and a list
+        of the number of errors of each type indexed by errorTypes value for
+        each hour between start and end which has any, ordered by hour. The
+        hour index counts hours since start, from zero. start must be on an
+        hour boundary. Each hour includes its start and excludes its end.
+
+        This takes a single query for the whole range, rather than one per
+        hour and kind of event as span_refused() and span_error_count() do.
+        """
+        error_counts = ''.join("""
+                  , count(*) FILTER (WHERE error_type = {0})::INTEGER""".format(
+                      error_type.value) for error_type in errorTypes)
+
+        cur = self.read.cursor('hourly_events', withhold=True)
+        try:
+            cur.execute("""
+                WITH events AS (
+                  SELECT
+                    "time", NULL::INTEGER AS error_type
+                  FROM
+                    "refused"
+                  WHERE
+                    "time" >= %(start)s AND "time" < %(end)s
+                  UNION ALL
+                  SELECT
+                    "time", "error_type"
+                  FROM
+                    "error"
+                  WHERE
+                    "time" >= %(start)s AND "time" < %(end)s
+                )
+                SELECT
+                  floor(extract(epoch FROM "time" - %(start)s) /
+                        3600)::INTEGER AS hour,
+                  count(*) FILTER (WHERE error_type IS NULL)::INTEGER
+                  {0}
+                FROM
+                  events
+                GROUP BY
+                  hour
+                ORDER BY
+                  hour
+                """.format(error_counts), {'start': start, 'end': end})
+            for row in cur:
+                yield row[0], row[1], list(row[2:])
+        finally:
+            cur.close()
+
+    def hourly_value_sketches(self, table, start, end):
+        """
+        Yield a tuple of the hour index and value sketch for each hour between
+        start and end which has values in the given table from
+        sketched_values, ordered by hour. The hour index counts hours since
+        start, from zero. start must be on an hour boundary.
+        """
+        cur = self.read.cursor('hourly_value_sketches', withhold=True)
+        try:
+            cur.execute("""
+                SELECT
+                  floor(extract(epoch FROM "hour" - %(start)s) / 3600)::INTEGER,
+                  "sketch"
+                FROM
+                  "value_sketch"
+                WHERE
+                  "source" = %(table)s
+                  AND "hour" >= %(start)s AND "hour" < %(end)s
+                ORDER BY
+                  "hour"
+                """, {'table': table, 'start': start, 'end': end})
+            for index, sketch in cur:
+                yield index, sketches.value_sketch_from_bytes(sketch)
+        finally:
+            cur.close()
+
+    def span_value_sketch(self, table, start, end):
+        """
+        Return the merged value sketch of the hours between start and end for
+        the given table from sketched_values. This gives medians, outlier
+        bounds, and means over the span without reading individual results;
+        see fnprobe.sketches.
+        """
+        merged = sketches.value_sketch([])
+        for _, sketch in self.hourly_value_sketches(table, start, end):
+            merged += sketch
+        return merged
+
     def span_identifier(self, start, end):
         """
         Return a tuple of the number of distinct identifiers and the number
@@ -540,22 +1443,68 @@ class Database:
     def span_store_size(self, start, end):
         """
         Return mean store size (after excluding outliers) in the given time
-        span.
+        span, or NaN if there are no store sizes in it.
+
+        Outliers are those farther than 1.5 * interquartile range from the
+        median. The quartiles and mean are computed by the database in one
+        query, so only the mean is transferred.
         """
         cur = self.read.cursor()
         cur.execute("""
+            WITH quartiles AS (
+              SELECT
+                percentile_cont(ARRAY[0.25, 0.5, 0.75])
+                  WITHIN GROUP (ORDER BY "gib") AS q
+              FROM
+                "store_size"
+              WHERE
+                "time" BETWEEN %(start)s AND %(end)s
+            )
             SELECT
-              "gib"
+              avg("gib")
             FROM
-              "store_size"
+              "store_size", quartiles
             WHERE
-              "time" BETWEEN %s AND %s
-            """, (start, end))
+              "time" BETWEEN %(start)s AND %(end)s
+              AND "gib" > q[2] - 1.5 * (q[3] - q[1])
+              AND "gib" < q[2] + 1.5 * (q[3] - q[1])
+            """, {'start': start, 'end': end})
+        mean, = cur.fetchone()
 
-        # Each result is a singleton tuple. Unpack before analysis.
-        sizes = exclude_outliers([x[0] for x in cur.fetchall()])
+        return float('NaN') if mean is None else mean
 
-        return mean(sizes)
+    def hourly_store_sizes(self, start, end):
+        """
+        Yield a tuple of the hour index and an array of the store sizes
+        reported in it for each hour between start and end which has any,
+        ordered by hour. The hour index counts hours since start, from zero.
+        start must be on an hour boundary. Each hour includes its start and
+        excludes its end.
+
+        Each result is read once, so spans of many hours can be combined from
+        these without reading results again for each span. See
+        fnprobe.backfill.window_exact_means().
+        """
+        cur = self.read.cursor('hourly_store_sizes', withhold=True)
+        try:
+            cur.execute("""
+                SELECT
+                  floor(extract(epoch FROM "time" - %(start)s) /
+                        3600)::INTEGER AS hour,
+                  array_agg("gib")
+                FROM
+                  "store_size"
+                WHERE
+                  "time" >= %(start)s AND "time" < %(end)s
+                GROUP BY
+                  hour
+                ORDER BY
+                  hour
+                """, {'start': start, 'end': end})
+            for index, sizes in cur:
+                yield index, numpy.array(sizes, numpy.float64)
+        finally:
+            cur.close()
 
     def span_refused(self, start, end):
         """Return the number of refused probes in the given time span."""
@@ -588,18 +1537,30 @@ class Database:
             """, {'start': start, 'end': end})
         return cur.fetchall()
 
-    def span_locations(self, start, end):
-        """Return the distinct locations seen over the given time span."""
-        cur = self.read.cursor()
-        cur.execute("""
-            SELECT
-              DISTINCT "location"
-            FROM
-              "location"
-            WHERE
-              "time" BETWEEN %s AND %s
-            """, (start, end))
-        return cur.fetchall()
+    def span_locations(self, start, end, chunk_size=100000):
+        """
+        Yield float arrays of the distinct locations seen over the given time
+        span, each of up to chunk_size locations. They are streamed from a
+        server-side cursor rather than all held in memory at once.
+        """
+        cur = self.read.cursor('span_locations', withhold=True)
+        try:
+            cur.execute("""
+                SELECT
+                  DISTINCT "location"
+                FROM
+                  "location"
+                WHERE
+                  "time" BETWEEN %s AND %s
+                """, (start, end))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield numpy.fromiter((location for location, in rows),
+                                     numpy.float64, len(rows))
+        finally:
+            cur.close()
 
     def span_peer_count(self, start, end):
         """Return binned peer counts over the time span."""
@@ -616,21 +1577,33 @@ class Database:
             """, (start, end))
         return cur.fetchall()
 
-    def span_links(self, start, end):
-        """Return the list lengths seen over the time span."""
-        cur = self.read.cursor()
-        cur.execute("""
-        SELECT
-          "length"
-        FROM
-          "link_lengths" lengths
-        JOIN
-          "peer_count" counts
-            ON counts.id = lengths.count_id
-        WHERE
-          "time" BETWEEN %s AND %s
-        """, (start, end))
-        return cur.fetchall()
+    def span_links(self, start, end, chunk_size=2000):
+        """
+        Yield float arrays of the link lengths seen over the time span, each
+        of those reported with up to chunk_size peer counts. They are
+        streamed from a server-side cursor rather than all held in memory at
+        once.
+        """
+        cur = self.read.cursor('span_links', withhold=True)
+        try:
+            cur.execute("""
+                SELECT
+                  "lengths"
+                FROM
+                  "peer_count"
+                WHERE
+                  "time" BETWEEN %s AND %s
+                  AND "lengths" != '{}'
+                """, (start, end))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield numpy.fromiter(
+                    chain.from_iterable(lengths for lengths, in rows),
+                    numpy.float64)
+        finally:
+            cur.close()
 
     def span_uptimes(self, start, end):
         """Return binned uptimes reported with identifier over the time span."""
@@ -647,45 +1620,36 @@ class Database:
             """, (start, end))
         return cur.fetchall()
 
-    def span_bulk_rejects(self, queue_type, start, end):
-        """Return binned bulk rejection percentages for the given queue type."""
+    def span_reject_histograms(self, start, end, max_percent=100):
+        """
+        Return a dict of arrays of the number of reports of each bulk reject
+        percentage over the time span, keyed by queue type from reject_types.
+        Each has an entry for every percentage from 0 to max_percent, with
+        those at max_percent including those above it.
+        """
         cur = self.read.cursor()
-        # Report of -1 means no data.
-        # Note that queue_type could cause injection because of the string
-        # formatting operations, but it should be used with elements from a
-        # fixed list, and the read connection should have only SELECT
-        # privileges.
+        # Grouping sets count the values of each queue type in one scan. Each
+        # row has the value for one of them, with the others NULL. The order
+        # of the queue types must match reject_types.
         cur.execute("""
             SELECT
-              {0}, count({0})
+              "bulk_request_chk", "bulk_request_ssk", "bulk_insert_chk",
+              "bulk_insert_ssk", count(*)
             FROM
               "reject_stats"
             WHERE
               "time" BETWEEN %s AND %s
-              AND {0} != -1
-            GROUP BY {0}
-            ORDER BY {0}
-            """.format(queue_type), (start, end))
-        return cur.fetchall()
-
-
-def exclude_outliers(array):
-    """
-    Return a copy of array with values farther than 1.5 * interquartile range
-    from the median excluded.
-    """
-    # Nothing to exclude from an empty array.
-    if not array:
-        return array
-
-    q1 = percentile(array, 25)
-    q3 = percentile(array, 75)
-    med = median(array)
+            GROUP BY GROUPING SETS (("bulk_request_chk"), ("bulk_request_ssk"),
+                                    ("bulk_insert_chk"), ("bulk_insert_ssk"))
+            """, (start, end))
 
-    # Outliers are 1.5 * interquartile range from the median.
-    outlier_range = 1.5 * (q3 - q1)
+        counts = numpy.zeros((len(reject_types), max_percent + 1),
+                             numpy.int64)
+        for row in cur:
+            for queue, percent in enumerate(row[:-1]):
+                # Report of -1 means no data.
+                if percent is not None and percent != -1:
+                    counts[queue, min(max(percent, 0), max_percent)] += row[-1]
 
-    lower_bound = med - outlier_range
-    upper_bound = med + outlier_range
+        return dict(zip(reject_types, counts))
 
-    return filter(lambda x: lower_bound < x < upper_bound, array)
@@ -1,141 +1,123 @@
 from __future__ import division
-import Gnuplot
 import logging
+import numpy
+from plotting import Plot, Series
 
 # Check for empty lists because Gnuplot-py will not plot if there are no entries.
 
 default_width = 900
 default_height = 600
 
-# TODO: Is this an appropriate place for such a list? Maybe fnprobe.db would
-# be better?
-reject_types = [ "bulk_request_chk",
-                 "bulk_request_ssk",
-                 "bulk_insert_chk",
-                 "bulk_insert_ssk"  ]
-
 # TODO: Repetitive width, height, filename existence and defaults; using them to initialize. Method annotation?
 
-def CDF(in_list):
+# Bin edges for distributions plotted as CDFs. Link lengths are plotted on a
+# logarithmic scale; as location is circular and [0,1), the largest
+# difference is 0.5.
+link_length_edges = numpy.logspace(-5, numpy.log10(0.5), 501)
+location_edges = numpy.linspace(0, 1, 1001)
+
+
+def histogram(chunks, edges):
     """
-    Takes an input list as from a database query: a list of singleton tuples
-    of values.
+    Takes an iterable of arrays of values, as from a database query, and an
+    array of bin edges.
 
-    Sorts the list and changes each item to be an x value followed by a y value
-    that sums to 100 over the list. Also returns the list.
+    Returns an array of the number of values in each bin. Values outside the
+    edges are counted in the first or last bin. Only one array of values is
+    held at a time.
     """
-    # Appended for each entry - should all add up to 1.
-    height = 100.0 / max(1.0, len(in_list))
+    counts = numpy.zeros(len(edges) - 1, numpy.int64)
+    for chunk in chunks:
+        counts += numpy.histogram(numpy.clip(chunk, edges[0], edges[-1]),
+                                  edges)[0]
+    return counts
 
-    # For GNUPlot smooth cumulative to work as intended the input must be sorted.
-    in_list.sort()
 
-    # TODO: This is strange. Is there a better way to add an element to each singleton tuple?
-    for index in xrange(len(in_list)):
-        in_list[index] = [in_list[index][0], height]
+def CDF(counts, edges):
+    """
+    Takes an array of the number of values in each bin and the bin edges, as
+    from histogram().
 
-    return in_list
+    Returns an array of rows of the upper edge of each bin followed by the
+    percentage of values in it or lower bins.
+    """
+    return numpy.column_stack((edges[1:], 100.0 * numpy.cumsum(counts) /
+                               max(1, counts.sum())))
 
 
 def makePercentageHistogram(histMax, results):
     """
     The histogram is capped at histMax.
-    results is a list of tuples of (value, occurrences).
+    results is a sequence of (value, occurrences) pairs of integer values.
 
-    Returns a list in which each element is [value, percentage] with those
-    at index maxHist being a sum of those at and above that value.
+    Returns an array of rows of each value from 0 to histMax followed by the
+    percentage of occurrences with that value, with those at histMax
+    including those above it.
     """
-    # The database does not return a row for unseen values - fill them in.
-    hist = []
-    for value in range(histMax + 1):
-        hist.append([value, 0])
-
-    # Find count per value
-    for result in results:
-        if result[0] < len(hist):
-            hist[result[0]][1] = result[1]
-        else:
-            hist[histMax][1] += result[1]
-
-    # Replace each occurrence count with percentage.
-    total = max(1.0, sum([x[1] for x in hist]))
-    for entry in hist:
-        entry[1] = 100 * entry[1] / total
-
-    return hist
-
-
-def g_init(width, height, filename):
-    g = Gnuplot.Gnuplot()
-    g('set terminal png size {0:n},{1:n}'.format(width, height))
-    g.set(output=filename)
+    results = numpy.asarray(results, numpy.float64).reshape(-1, 2)
+    values = numpy.clip(results[:, 0], 0, histMax).astype(numpy.intp)
 
-    return g
+    # The database does not return a row for unseen values - bincount() fills
+    # them in.
+    hist = numpy.bincount(values, weights=results[:, 1],
+                          minlength=histMax + 1)
 
-
-def add_sample_size_label(g, size):
-    g('set label "N = {0:n}" at graph 0.5, 0.9 center'.format(size))
+    return numpy.column_stack((numpy.arange(histMax + 1),
+                               100 * hist / max(1.0, hist.sum())))
 
 
 def get_total_occurrences(in_list):
     """
     Return total occurrences. Same input as makePercentageHistogram().
     """
-    total = 0
+    return sum(occurrences for _, occurrences in in_list)
 
-    # TODO: Is there a one-liner for this?
-    for _, occurrences in in_list:
-        total += occurrences
 
-    return total
+# Each plot_* function returns a plotting.Plot. analyze.py renders each in
+# the stage that made it with one of plotting.backends; see fnprobe.stages.
 
 
-def plot_link_length(lengths, width=default_width, height=default_height,
-                     filename=None):
-    if len(lengths) is 0:
+def plot_link_length(lengths, references=(), width=default_width,
+                     height=default_height, filename=None):
+    """
+    lengths is an iterable of arrays of link lengths. references is a
+    sequence of (title, CDF) pairs of distributions to compare against, with
+    CDFs as from CDF().
+    """
+    counts = histogram(lengths, link_length_edges)
+    if not counts.any():
         logging.warning("No link lengths to plot.")
-        lengths = [[0.01]]
-
-    g = g_init(width, height, filename)
 
-    g.title('Link Length Distribution')
-    g.xlabel('Link Length (delta location)')
-    g.ylabel('Percent links with this length or less')
-    add_sample_size_label(g, len(lengths))
-
-    g('set logscale x')
-    # As location is circular and [0,1), largest difference is 0.5.
-    g.set(xrange='[0.00001:0.5]')
-    g.set(yrange='[0:100]')
-
-    g.plot(Gnuplot.Data(CDF(lengths), smooth='cumulative', title='Measured'),
-           Gnuplot.File('ideal-link', smooth='cumulative', title='Ideal'),
-           Gnuplot.File('flat-link', smooth='cumulative', title='Flat'))
-
-# TODO: Generate the flat and ideal link length distribution files if they
-# are missing. See:
-# flat: https://github.com/Thynix/routing-simulator/blob/master/src/main/java/org/freenetproject/routing_simulator/graph/linklength/UniformLinkSource.java
-# ideal: https://github.com/Thynix/routing-simulator/blob/master/src/main/java/org/freenetproject/routing_simulator/graph/linklength/KleinbergLinkSource.java
+    return Plot(filename, width, height,
+                title='Link Length Distribution',
+                xlabel='Link Length (delta location)',
+                ylabel='Percent links with this length or less',
+                series=[Series(CDF(counts, link_length_edges), 'Measured',
+                               'lines')] +
+                       [Series(cdf, title, 'lines')
+                        for title, cdf in references],
+                xrange=(0.00001, 0.5), yrange=(0, 100), logx=True, key=True,
+                sample_size=counts.sum(), xtics=None,
+                histogram=False)
 
 
 def plot_location_dist(locations, width=default_width, height=default_height,
                        filename=None):
-    if len(locations) is 0:
+    """
+    locations is an iterable of arrays of locations.
+    """
+    counts = histogram(locations, location_edges)
+    if not counts.any():
         logging.warning("No locations to plot.")
-        locations = [[0.5]]
 
-    g = g_init(width, height, filename)
-    g('set key off')
-
-    g.title('Location Distribution')
-    g.xlabel('Location')
-    g.ylabel('Percent nodes with this location or less')
-    add_sample_size_label(g, len(locations))
-
-    g.set(xrange='[0:1.0]')
-    g.set(yrange='[0:100]')
-
-    g.plot(Gnuplot.Data(CDF(locations), smooth='cumulative'))
+    return Plot(filename, width, height,
+                title='Location Distribution',
+                xlabel='Location',
+                ylabel='Percent nodes with this location or less',
+                series=[Series(CDF(counts, location_edges), None, 'lines')],
+                xrange=(0, 1.0), yrange=(0, 100), logx=False, key=False,
+                sample_size=counts.sum(), xtics=None,
+                histogram=False)
 
 
 def plot_peer_count(counts, histMax, width=default_width,
@@ -144,58 +126,50 @@ def plot_peer_count(counts, histMax, width=default_width,
         logging.warning("No peer counts to plot.")
         counts = [[0, 0]]
 
-    g = g_init(width, height, filename)
-    g('set key off')
-
-    g.title('Peer Count Distribution')
-    g.xlabel('Reported Peers')
-    g.ylabel('Percent of Reports')
     # TODO: Histogram-ness? Count total occurences.
-    add_sample_size_label(g, get_total_occurrences(counts))
-
-    g('set style data histogram')
-    g('set style fill solid border -1')
-
     # Could mean missing the details of things beyond the bounds.
-    g.set(xrange='[1:%s]' % histMax)
-    g.set(yrange='[0:]')
-    g('set xtics 5')
+    return Plot(filename, width, height,
+                title='Peer Count Distribution',
+                xlabel='Reported Peers',
+                ylabel='Percent of Reports',
+                series=[Series(makePercentageHistogram(histMax, counts), None,
+                               'boxes')],
+                xrange=(1, histMax), yrange=(0, None), logx=False, key=False,
+                sample_size=get_total_occurrences(counts), xtics=5,
+                histogram=True)
 
-    g.plot(Gnuplot.Data(makePercentageHistogram(histMax, counts), with_='boxes'))
 
 def plot_bulk_reject(counts, width=default_width, height=default_height,
                      filename=None):
-    g = g_init(width, height, filename)
-
-    g.title('Reject Distribution')
-    g.xlabel('Reported reject percentage')
-    g.ylabel('Percent reports')
-
-    # counts is a list of (value, occurrences) keyed by queue type. Any
-    # sample from any of the queue types could be omitted as "no data",
-    # so the actual sample size is not available from here. Use
-    # whichever happened to have the least "no data".
-    add_sample_size_label(g,
-                          max([get_total_occurrences(x)
-                               for x in counts.itervalues()]))
-
-    g('set style data histogram')
-    g('set logscale x')
-
-    g.set(xrange='[1:100]')
-    g.set(yrange='[0:]')
-
-    assert len(counts) > 0
-    for item in counts.items():
-        key = item[0]
-        if len(item[1]) is 0:
-            logging.warning("No entries for {0}.".format(item[0]))
-            counts[key] = [[0, 0]]
-
-        counts[key] = makePercentageHistogram(100, item[1])
-
-    # Title of each is the database table name, which is the map key.
-    g.plot(*[Gnuplot.Data(item[1], title=item[0], with_='lines') for item in counts.iteritems()])
+    """
+    counts is a dict of arrays of the number of reports of each reject
+    percentage keyed by queue type, as from
+    Database.span_reject_histograms().
+    """
+    # Any sample from any of the queue types could be omitted as "no data",
+    # so the actual sample size is not available from here. Use whichever
+    # happened to have the least "no data".
+    sample_size = max(hist.sum() for hist in counts.itervalues())
+
+    series = []
+    for queue_type, hist in sorted(counts.iteritems()):
+        if not hist.any():
+            logging.warning("No entries for {0}.".format(queue_type))
+
+        # Title of each is the database column name, which is the map key.
+        series.append(Series(
+            numpy.column_stack((numpy.arange(len(hist)),
+                                100 * hist / max(1, hist.sum()))),
+            queue_type, 'lines'))
+
+    return Plot(filename, width, height,
+                title='Reject Distribution',
+                xlabel='Reported reject percentage',
+                ylabel='Percent reports',
+                series=series,
+                xrange=(1, 100), yrange=(0, None), logx=True, key=True,
+                sample_size=sample_size, xtics=None,
+                histogram=True)
 
 
 def plot_uptime(uptimes, histMax, width=default_width, height=default_height,
@@ -206,19 +180,15 @@ def plot_uptime(uptimes, histMax, width=default_width, height=default_height,
 
     # Adjust report by inverse uptime to get a network percentage estimate:
     # nodes with high uptime are more often online to appear in results.
-    uptimes = [(uptime, count / (uptime + 10)) for uptime, count in uptimes]
-
-    g = g_init(width, height, filename)
-
-    g.title('Uptime Distribution')
-    g.xlabel('Reported 7-day uptime percentage')
-    g.ylabel('Estimated network percentage')
-    add_sample_size_label(g, get_total_occurrences(uptimes))
-
-    g('set style data histogram')
-    g('set style fill solid border -1')
-
-    g.set(xrange='[0:120]')
-    g.set(yrange='[0:]')
-
-    g.plot(Gnuplot.Data(makePercentageHistogram(histMax, uptimes), with_='boxes'))
+    uptimes = numpy.asarray(uptimes, numpy.float64).reshape(-1, 2)
+    uptimes[:, 1] /= uptimes[:, 0] + 10
+
+    return Plot(filename, width, height,
+                title='Uptime Distribution',
+                xlabel='Reported 7-day uptime percentage',
+                ylabel='Estimated network percentage',
+                series=[Series(makePercentageHistogram(histMax, uptimes), None,
+                               'boxes')],
+                xrange=(0, 120), yrange=(0, None), logx=False, key=True,
+                sample_size=get_total_occurrences(uptimes), xtics=None,
+                histogram=True)
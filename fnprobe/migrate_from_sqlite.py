@@ -5,6 +5,8 @@ from datetime import timedelta
 import update_db
 import signal
 import sys
+from itertools import groupby
+from operator import itemgetter
 from db import update_id_sequence
 
 new_database = update_db.main()
@@ -162,26 +164,39 @@ for row in SQLite.execute("""
 new_database.add.commit()
 update_id_sequence(Postgres_maint, 'peer_count')
 
-# Link lengths is out of alphabetical order to be after peer_count. It
-# references peer_count IDs. Early ids might be broken as 0.
-for row in SQLite.execute("""
+# Link lengths is out of alphabetical order to be after peer_count. They are
+# stored with the peer count they belong to, which the id column references.
+# Early ids might be broken as 0.
+Postgres_read.execute("""
+SELECT
+  max(id)
+FROM
+  peer_count
+WHERE
+  lengths != '{}'
+""")
+resume_count_id = Postgres_read.fetchone()[0] or 0
+
+for count_id, rows in groupby(SQLite.execute("""
     SELECT
-      ROWID, length, id
+      id, length
     FROM
       link_lengths
     WHERE
-      ROWID > ?1 AND id IS NOT 0
-    ORDER BY ROWID ASC
-    """, (resume_id('link_lengths'),)):
+      id > ?1
+    ORDER BY id ASC, ROWID ASC
+    """, (resume_count_id,)), itemgetter(0)):
 
-    Postgres_add.execute("""
-    INSERT INTO
-      link_lengths(id, length, count_id)
-    VALUES
-      (%s, %s, %s)
-    """, row)
-new_database.add.commit()
-update_id_sequence(Postgres_maint, 'link_lengths')
+    # The record addition user cannot update.
+    Postgres_maint.execute("""
+    UPDATE
+      peer_count
+    SET
+      lengths = %s
+    WHERE
+      id = %s
+    """, ([length for _, length in rows], count_id))
+new_database.maintenance.commit()
 
 for row in SQLite.execute("""
     SELECT
@@ -342,6 +357,8 @@ update_id_sequence(Postgres_maint, 'refused')
 
 logging.warning("Migration complete. Recreating indexes.")
 new_database.create_indexes()
+logging.warning("Summarizing results by hour.")
+new_database.rebuild_derived()
 
 logging.warning("Analyzing.")
 Postgres_read.execute("""ANALYZE VERBOSE""")
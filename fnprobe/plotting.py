@@ -0,0 +1,118 @@
+from __future__ import division
+from collections import namedtuple
+
+# Plots are described as data so that they can be rendered by any backend,
+# and in worker processes. Each backend is a function which takes a Plot and
+# writes it to its filename.
+#
+# * gnuplot: Gnuplot-py, which runs gnuplot and sends it data as text.
+# * matplotlib: renders in-process directly from NumPy arrays.
+#
+# Backends are imported when first used, so only the one in use needs to be
+# installed.
+
+# Ranges are (low, high) pairs, either of which can be None to leave it to the
+# backend. sample_size is shown as "N = ..." if it is not None. xtics is the
+# interval between x-axis tick marks, or None for the default. histogram sets
+# gnuplot's data style to histogram, with solid fill for boxes; other
+# backends draw each series in its own style regardless.
+Plot = namedtuple('Plot', ['filename', 'width', 'height', 'title', 'xlabel',
+                           'ylabel', 'series', 'xrange', 'yrange', 'logx',
+                           'key', 'sample_size', 'xtics', 'histogram'])
+
+# data is an array of rows of x and y. style is either "lines" or "boxes".
+# Series without a title are left out of the key.
+Series = namedtuple('Series', ['data', 'title', 'style'])
+
+
+def sample_size_label(size):
+    return 'N = {0:n}'.format(size)
+
+
+def render_gnuplot(plot):
+    import Gnuplot
+
+    g = Gnuplot.Gnuplot()
+    g('set terminal png size {0:n},{1:n}'.format(plot.width, plot.height))
+    g.set(output=plot.filename)
+
+    g.title(plot.title)
+    g.xlabel(plot.xlabel)
+    g.ylabel(plot.ylabel)
+    if not plot.key:
+        g('set key off')
+    if plot.sample_size is not None:
+        g('set label "{0}" at graph 0.5, 0.9 center'.format(
+            sample_size_label(plot.sample_size)))
+    if plot.logx:
+        g('set logscale x')
+
+    def gnuplot_range(bounds):
+        return '[{0}:{1}]'.format(*['' if bound is None else bound
+                                    for bound in bounds])
+
+    g.set(xrange=gnuplot_range(plot.xrange))
+    g.set(yrange=gnuplot_range(plot.yrange))
+
+    if plot.histogram:
+        g('set style data histogram')
+        if any(series.style == 'boxes' for series in plot.series):
+            g('set style fill solid border -1')
+    if plot.xtics is not None:
+        g('set xtics {0}'.format(plot.xtics))
+
+    items = []
+    for series in plot.series:
+        options = {'with_': series.style}
+        if series.title is not None:
+            options['title'] = series.title
+        items.append(Gnuplot.Data(series.data, **options))
+
+    g.plot(*items)
+
+
+def render_matplotlib(plot):
+    # Agg renders to files without a display, and without pyplot's global
+    # state.
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from matplotlib.ticker import MultipleLocator
+
+    dpi = 100
+    figure = Figure(figsize=(plot.width / dpi, plot.height / dpi), dpi=dpi)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(1, 1, 1)
+
+    axes.set_title(plot.title)
+    axes.set_xlabel(plot.xlabel)
+    axes.set_ylabel(plot.ylabel)
+    if plot.logx:
+        axes.set_xscale('log')
+
+    for series in plot.series:
+        if series.style == 'boxes':
+            axes.bar(series.data[:, 0], series.data[:, 1], width=1.0,
+                     edgecolor='black', label=series.title)
+        else:
+            axes.plot(series.data[:, 0], series.data[:, 1],
+                      label=series.title)
+
+    axes.set_xlim(*plot.xrange)
+    axes.set_ylim(*plot.yrange)
+    if plot.xtics is not None:
+        axes.xaxis.set_major_locator(MultipleLocator(plot.xtics))
+    if plot.sample_size is not None:
+        axes.text(0.5, 0.9, sample_size_label(plot.sample_size),
+                  horizontalalignment='center', transform=axes.transAxes)
+    if plot.key and any(series.title is not None
+                        for series in plot.series):
+        axes.legend()
+
+    figure.savefig(plot.filename)
+
+
+backends = {
+    'gnuplot': render_gnuplot,
+    'matplotlib': render_matplotlib,
+}
+
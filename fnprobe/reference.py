@@ -0,0 +1,94 @@
+from __future__ import division
+import hashlib
+import logging
+import numpy
+import os
+from gnuplots import histogram, CDF
+
+# Reference link length distributions to compare measured ones against, from
+# simulated networks of nodes at uniformly random locations. Each link is made
+# by picking a distance, going that far from a random node in a random
+# direction, and connecting to the closest node there.
+#
+# * kleinberg: distances with density proportional to 1 / distance, down to
+#   the mean distance between nodes, which is ideal for routing.
+# * uniform: distances uniform up to 0.5, as if peers were chosen at random.
+
+kinds = ['kleinberg', 'uniform']
+
+# Changes whenever the way links are simulated does, so that cached
+# distributions from an earlier version are not used.
+model_version = 1
+
+
+def simulate_links(kind, nodes, samples, seed=0):
+    """
+    Return an array of samples link lengths of the given kind in a network
+    of the given number of nodes, generated deterministically from seed.
+    Links from a node to itself are left out, so there can be slightly
+    fewer.
+    """
+    random = numpy.random.RandomState(seed)
+    locations = numpy.sort(random.random_sample(nodes))
+    sources = locations[random.randint(nodes, size=samples)]
+
+    if kind == 'kleinberg':
+        shortest = 1 / nodes
+        distances = shortest * (0.5 / shortest) ** \
+            random.random_sample(samples)
+    elif kind == 'uniform':
+        distances = 0.5 * random.random_sample(samples)
+    else:
+        raise ValueError("Unknown link length distribution '{0}'.".format(
+            kind))
+
+    directions = numpy.where(random.random_sample(samples) < 0.5, -1, 1)
+    targets = (sources + directions * distances) % 1.0
+
+    # The closest node is one of those on either side of the target.
+    above = numpy.searchsorted(locations, targets) % nodes
+    candidates = numpy.stack((locations[above], locations[above - 1]))
+    peers = candidates[numpy.argmin(circular_distance(candidates, targets),
+                                    axis=0), numpy.arange(samples)]
+
+    lengths = circular_distance(peers, sources)
+    return lengths[lengths > 0]
+
+
+def circular_distance(a, b):
+    """Return the distance between locations on the [0, 1) circle."""
+    difference = numpy.abs(a - b)
+    return numpy.minimum(difference, 1 - difference)
+
+
+def link_length_cdf(kind, edges, nodes=5000, samples=1000000, seed=0,
+                    cache_dir=None):
+    """
+    Return the CDF of simulate_links() binned by edges, as from
+    gnuplots.CDF().
+
+    If cache_dir is given, the CDF is saved there the first time, and loaded
+    from there afterwards. Cached files are named with every input they
+    depend on.
+    """
+    if cache_dir is not None:
+        digest = hashlib.sha1(numpy.asarray(edges, numpy.float64).tobytes())
+        path = os.path.join(cache_dir, '{0}-v{1}-nodes{2}-samples{3}-seed{4}-'
+                                       'edges{5}.npy'.format(
+                                           kind, model_version, nodes,
+                                           samples, seed,
+                                           digest.hexdigest()[:12]))
+        if os.path.exists(path):
+            return numpy.load(path)
+
+    logging.info("Simulating {0} {1} link lengths among {2} nodes.".format(
+        samples, kind, nodes))
+    cdf = CDF(histogram([simulate_links(kind, nodes, samples, seed)], edges),
+              edges)
+
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        numpy.save(path, cdf)
+
+    return cdf
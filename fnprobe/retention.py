@@ -0,0 +1,65 @@
+import argparse
+import datetime
+import logging
+from ConfigParser import SafeConfigParser
+import psycopg2.tz
+import update_db
+
+# Remove results older than configured in retention.config, so that storage
+# does not grow without limit. Raw results are kept for raw_days, and the
+# hourly summaries in derived tables, which analysis can use once raw results
+# are gone, for hourly_days. Partitions of months wholly before the raw cutoff
+# are dropped, or archived first if archive_dir is set.
+
+parser = argparse.ArgumentParser(description="Drop or archive probe results "
+                                             "older than the retention "
+                                             "period.")
+parser.add_argument('--config', dest='config', default='retention.config',
+                    help='Path to the retention configuration file. See '
+                         'retention.config_sample. Default '
+                         'retention.config.')
+parser.add_argument('--dry-run', dest='dry_run', default=False,
+                    action='store_true',
+                    help='Only list the partitions that would be dropped, '
+                         'and the rows that would be deleted.')
+args = parser.parse_args()
+
+config_parser = SafeConfigParser()
+if not config_parser.read(args.config):
+    parser.error("Could not read {0}.".format(args.config))
+config = config_parser.defaults()
+
+raw_days = int(config['raw_days'])
+hourly_days = config.get('hourly_days')
+hourly_days = int(hourly_days) if hourly_days else None
+archive_dir = config.get('archive_dir') or None
+
+if hourly_days is not None and hourly_days < raw_days:
+    parser.error("hourly_days must be at least raw_days, or derived tables "
+                 "would be missing hours which still have results.")
+
+database = update_db.main()
+
+now = datetime.datetime.now(psycopg2.tz.FixedOffsetTimezone(0))
+raw_cutoff = now - datetime.timedelta(days=raw_days)
+logging.warning("Keeping results from {0} on.".format(raw_cutoff))
+
+if args.dry_run:
+    for table, partition, start in database.expired_partitions(raw_cutoff):
+        print("Would drop {0}.".format(partition))
+    for default, count in database.expired_default_rows(raw_cutoff):
+        print("Would delete {0} rows from {1}.".format(count, default))
+else:
+    database.drop_results_before(raw_cutoff, archive_dir)
+
+if hourly_days is not None:
+    hourly_cutoff = now - datetime.timedelta(days=hourly_days)
+    # Only whole hours are kept.
+    hourly_cutoff = hourly_cutoff.replace(minute=0, second=0, microsecond=0)
+    logging.warning("Keeping hourly summaries from {0} on.".format(
+        hourly_cutoff))
+    if args.dry_run:
+        for table, count in database.expired_derived_rows(hourly_cutoff):
+            print("Would delete {0} rows from {1}.".format(count, table))
+    else:
+        database.drop_derived_before(hourly_cutoff)
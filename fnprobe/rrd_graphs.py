@@ -0,0 +1,65 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import rrdtool
+from collections import namedtuple
+
+# RRDTool graphs are described as data so that they can be rendered in worker
+# processes, and skipped when nothing they are drawn from has changed. A cache
+# file records, for each graph filename, a key made from the arguments it was
+# last rendered with and the time of the last update to the RRD then.
+
+# arguments is the list of arguments to rrdtool.graph() after the filename.
+Graph = namedtuple('Graph', ['filename', 'arguments'])
+
+
+def graph_key(graph, last):
+    return hashlib.sha1(json.dumps([last] + list(graph.arguments))) \
+        .hexdigest()
+
+
+def render_graph(graph):
+    rrdtool.graph(graph.filename, *graph.arguments)
+
+
+def render_graphs(graphs, rrd, cache_path, jobs=1):
+    """
+    Render a list of Graphs drawn from the RRD at path rrd, in up to jobs
+    processes. A graph is skipped if its file exists and, according to the
+    cache file at cache_path, was rendered with the same arguments when the
+    RRD was last updated at the same time.
+
+    Return the number of graphs rendered.
+    """
+    last = rrdtool.last(rrd)
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except IOError:
+        cache = {}
+
+    keys = dict((graph.filename, graph_key(graph, last)) for graph in graphs)
+    stale = [graph for graph in graphs
+             if cache.get(graph.filename) != keys[graph.filename] or
+             not os.path.exists(graph.filename)]
+
+    jobs = min(jobs, len(stale))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        pool.map(render_graph, stale, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        for graph in stale:
+            render_graph(graph)
+
+    # Only record graphs once they have all been rendered, and replace the
+    # cache file whole so that it is not left partly written.
+    for graph in stale:
+        cache[graph.filename] = keys[graph.filename]
+    with open(cache_path + '.new', 'w') as cache_file:
+        json.dump(cache, cache_file, indent=0, sort_keys=True)
+    os.rename(cache_path + '.new', cache_path)
+
+    return len(stale)
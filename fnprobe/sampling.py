@@ -0,0 +1,208 @@
+from __future__ import division
+import logging
+import math
+import random
+from string import split
+from twisted.internet import reactor
+
+
+def parse_weights(spec):
+    """
+    Parse a comma-separated list of items, each optionally followed by a colon
+    and a weight, into a list of (item, weight) tuples in order of first
+    occurrence. An item without a weight has a weight of 1, and repeated
+    items add their weights together, so "A,A,B" is the same as "A:2,B:1".
+    """
+    weights = {}
+    order = []
+    for entry in split(spec, ','):
+        entry = entry.strip()
+        if not entry:
+            continue
+
+        if ':' in entry:
+            item, weight = split(entry, ':', 1)
+            item = item.strip()
+            weight = float(weight)
+        else:
+            item, weight = entry, 1.0
+
+        if weight < 0:
+            raise ValueError("Weight for {0} is negative.".format(item))
+
+        if item not in weights:
+            order.append(item)
+            weights[item] = 0
+        weights[item] += weight
+
+    return [(name, weights[name]) for name in order]
+
+
+class AliasTable(object):
+    """
+    Samples items in proportion to their weights in constant time, using
+    Vose's alias method. Construction takes time linear in the number of
+    items.
+    """
+
+    def __init__(self, weights):
+        """
+        :type weights: list of (item, weight) tuples. Weights need not sum
+        to anything in particular, but at least one must be positive.
+        """
+        self.items = [item for item, _ in weights]
+        total = sum(weight for _, weight in weights)
+        if not total > 0:
+            raise ValueError("No item has a positive weight.")
+
+        count = len(weights)
+        # Scale so that the average weight is 1.
+        scaled = [weight * count / total for _, weight in weights]
+        self.probability = [1.0] * count
+        self.alias = range(count)
+
+        small = [i for i, weight in enumerate(scaled) if weight < 1]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1]
+
+        # Fill each underfull column with the remainder from an overfull one.
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+
+            scaled[more] -= 1 - scaled[less]
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+
+        # Anything left is full up to rounding error, and keeps probability 1.
+
+    def sample(self, generator=random):
+        column = generator.randrange(len(self.items))
+        if generator.random() < self.probability[column]:
+            return self.items[column]
+        return self.items[self.alias[column]]
+
+
+class MeanEstimate(object):
+    """
+    Running mean and variance of observed values, using Welford's algorithm.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def relative_error(self):
+        """
+        Return the standard error of the mean relative to the mean, or None
+        if there is not enough information.
+        """
+        if self.count < 2 or self.mean == 0:
+            return None
+        variance = self.m2 / (self.count - 1)
+        return math.sqrt(variance / self.count) / abs(self.mean)
+
+
+class DistinctEstimate(object):
+    """
+    Counts repeated observations of values, such as probe identifiers. The
+    size of the population they are drawn from is estimated from how often
+    they repeat, so the relative error of that estimate shrinks with the
+    number of repeats.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seen = set()
+
+    def observe(self, value):
+        self.count += 1
+        self.seen.add(value)
+
+    def relative_error(self):
+        repeats = self.count - len(self.seen)
+        if repeats < 1:
+            return None
+        return 1 / math.sqrt(repeats)
+
+
+class TypeSelector(object):
+    """
+    Chooses probe types with probability in proportion to their weights.
+
+    If adaptive, the weights are adjusted every interval seconds: each base
+    weight is multiplied by how large the relative error of the estimate
+    made from that type of result was over the interval compared to the
+    average over all types, limited to between 1 / max_shift and max_shift.
+    This sends more of the probes which add the most information. Types
+    without enough results for an estimate keep their base weight.
+    """
+
+    def __init__(self, weights, adaptive=False, interval=3600, max_shift=2,
+                 estimates=None, clock=reactor):
+        """
+        :type weights: list of (type, weight) tuples.
+        :type estimates: dict of type to the class of estimate made from
+        values observed for it. Types not included use MeanEstimate.
+        """
+        self.base = weights
+        self.adaptive = adaptive
+        self.interval = interval
+        self.max_shift = max_shift
+        self.estimate_types = estimates or {}
+        self.clock = clock
+
+        self.table = AliasTable(weights)
+        self.reset()
+
+    def reset(self):
+        self.started = self.clock.seconds()
+        self.estimates = dict((probe_type,
+                               self.estimate_types.get(probe_type,
+                                                       MeanEstimate)())
+                              for probe_type, _ in self.base)
+
+    def choose(self):
+        """Return a probe type."""
+        if self.adaptive and \
+                self.clock.seconds() - self.started >= self.interval:
+            self.reweight()
+        return self.table.sample()
+
+    def observe(self, probe_type, value):
+        """Record a value from a result of the given type."""
+        if self.adaptive and probe_type in self.estimates:
+            self.estimates[probe_type].observe(value)
+
+    def reweight(self):
+        errors = dict((probe_type, estimate.relative_error())
+                      for probe_type, estimate in self.estimates.iteritems())
+        known = [error for error in errors.itervalues()
+                 if error is not None and error > 0]
+        self.reset()
+        if not known:
+            return
+
+        average = sum(known) / len(known)
+        weights = []
+        for probe_type, weight in self.base:
+            if errors[probe_type]:
+                shift = errors[probe_type] / average
+                weight *= min(self.max_shift, max(1 / self.max_shift, shift))
+            weights.append((probe_type, weight))
+
+        logging.info("Probe type weights are now {0}.".format(
+            ', '.join('{0}:{1:.3g}'.format(probe_type, weight)
+                      for probe_type, weight in weights)))
+        self.table = AliasTable(weights)
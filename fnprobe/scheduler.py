@@ -0,0 +1,140 @@
+from __future__ import division
+import logging
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+# Outcomes of a probe, as reported to ProbeScheduler.finished().
+RESULT = 'result'
+REFUSED = 'refused'
+OVERLOAD = 'overload'
+FAILED = 'failed'
+
+# Outcomes which indicate the node or the network is being asked too much.
+congestion = [REFUSED, OVERLOAD, FAILED]
+
+
+class ProbeScheduler(object):
+    """
+    Decides when to send probes. Sending is limited in three ways:
+
+    * A token bucket refilled at the current rate, holding at most burst
+      probes. This averages to the rate but allows catching up after a pause.
+    * A window of at most window probes awaiting a response at once.
+    * The current rate itself adapts: it is multiplied by decrease when probes
+      are refused, fail with OVERLOAD, or time out, and recovers additively
+      towards the configured maximum rate as results arrive.
+
+    Only those outcomes change the rate. How long probes take is tracked
+    solely to avoid decreasing the rate more than once per average probe
+    duration, as the responses to probes already sent reflect the old rate.
+    """
+
+    def __init__(self, rate, burst, window, decrease=0.75, increase=0.01,
+                 minimum=0.1, clock=reactor):
+        """
+        :type rate: float maximum probes per minute.
+        :type burst: int probes which can be sent at once after a pause.
+        :type window: int maximum outstanding probes.
+        :param decrease: factor by which the rate is multiplied on congestion.
+        :param increase: fraction of the maximum rate regained per result.
+        :param minimum: fraction of the maximum rate below which the rate is
+                        never decreased.
+        """
+        self.max_rate = rate
+        self.burst = burst
+        self.window = window
+        self.decrease = decrease
+        self.increase = increase
+        self.minimum = minimum
+        self.clock = clock
+
+        # Fraction of the maximum rate currently used.
+        self.factor = 1.0
+        self.tokens = 0
+        self.outstanding = 0
+        # Exponentially weighted average of response time in seconds.
+        self.mean_duration = None
+        self.last_decrease = None
+
+        # Incremented on every start and stop so that probes from a previous
+        # connection are not counted against this one, or once stopped.
+        self.generation = 0
+        self.send = None
+        self.last_tick = None
+        self.loop = None
+
+    def rate(self):
+        """Return the current rate in probes per minute."""
+        return self.max_rate * self.factor
+
+    def start(self, send):
+        """
+        Start sending probes with send(), which should return False if it
+        could not send one.
+        """
+        self.generation += 1
+        self.send = send
+        self.outstanding = 0
+        self.tokens = 0
+        self.last_tick = self.clock.seconds()
+
+        self.loop = LoopingCall(self.tick)
+        self.loop.clock = self.clock
+        # Check often enough to send at the maximum rate smoothly.
+        self.loop.start(min(1.0, 60 / self.max_rate))
+
+    def stop(self):
+        """
+        Stop sending probes. Outstanding probes are forgotten: their outcomes
+        no longer affect the outstanding count or the rate.
+        """
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = None
+        self.generation += 1
+        self.outstanding = 0
+
+    def tick(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_tick) *
+                                                   self.rate() / 60)
+        self.last_tick = now
+
+        while self.tokens >= 1 and self.outstanding < self.window:
+            if not self.send():
+                break
+            self.tokens -= 1
+            self.outstanding += 1
+
+    def finished(self, generation, outcome, duration=None):
+        """
+        Record the outcome of a probe sent during the given generation, and
+        how many seconds it took if it got a response.
+        """
+        if generation != self.generation:
+            return
+        self.outstanding -= 1
+
+        if duration is not None:
+            if self.mean_duration is None:
+                self.mean_duration = duration
+            else:
+                self.mean_duration += 0.1 * (duration - self.mean_duration)
+
+        if outcome in congestion:
+            self.congested(outcome)
+        elif outcome == RESULT:
+            self.factor = min(1.0, self.factor + self.increase)
+
+    def congested(self, outcome):
+        now = self.clock.seconds()
+        if (self.last_decrease is not None and self.mean_duration is not None
+                and now - self.last_decrease < self.mean_duration):
+            return
+
+        self.last_decrease = now
+        factor = max(self.minimum, self.factor * self.decrease)
+        if factor != self.factor:
+            self.factor = factor
+            logging.warning("Probe {0}; reducing rate to {1:.1f} probes per "
+                            "minute.".format(outcome, self.rate()))
@@ -0,0 +1,417 @@
+import logging
+import numpy
+import psycopg2
+import sketches
+import time
+from collections import Counter
+from db import sketched_values
+from time_utils import toPosix, fromPosix
+from twisted.application import service
+from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+
+# Columns of each result table in the order rows for them are given to the
+# sink. The first column is the name of the node which gathered the result.
+# peer_count rows end with the list of reported link lengths, as floats.
+columns = {
+    'bandwidth': ('node', 'time', 'duration', 'htl', 'kib'),
+    'build': ('node', 'time', 'duration', 'htl', 'build'),
+    'error': ('node', 'time', 'duration', 'htl', 'probe_type', 'error_type',
+              'local', 'code'),
+    'identifier': ('node', 'time', 'duration', 'htl', 'identifier', 'percent'),
+    'location': ('node', 'time', 'duration', 'htl', 'location'),
+    'peer_count': ('node', 'time', 'duration', 'htl', 'peers', 'lengths'),
+    'refused': ('node', 'time', 'duration', 'htl', 'probe_type'),
+    'reject_stats': ('node', 'time', 'duration', 'htl', 'bulk_request_chk',
+                     'bulk_request_ssk', 'bulk_insert_chk',
+                     'bulk_insert_ssk'),
+    'store_size': ('node', 'time', 'duration', 'htl', 'gib'),
+    'uptime_48h': ('node', 'time', 'duration', 'htl', 'percent'),
+    'uptime_7d': ('node', 'time', 'duration', 'htl', 'percent'),
+}
+
+
+def insert_rows(cur, table, rows, table_columns=None, conflict=""):
+    """
+    Insert the rows into the table with a single multi-row statement. Rows are
+    in the order of table_columns, which defaults to those in columns.
+    conflict is an optional ON CONFLICT clause.
+    """
+    if table_columns is None:
+        table_columns = columns[table]
+
+    placeholder = '(' + ', '.join(['%s'] * len(table_columns)) + ')'
+    cur.execute("""
+    INSERT INTO
+      "{0}"({1})
+      values {2}
+    {3}
+    """.format(table, ', '.join(table_columns),
+               ', '.join(cur.mogrify(placeholder, row) for row in rows),
+               conflict))
+
+
+def rollup_identifiers(cur, rows):
+    """
+    Add identifier rows to the counts per hour in identifier_hourly.
+    """
+    time_index = columns['identifier'].index('time')
+    identifier_index = columns['identifier'].index('identifier')
+
+    counts = Counter()
+    for row in rows:
+        hour = fromPosix(toPosix(row[time_index]) // 3600 * 3600)
+        counts[(hour, row[identifier_index])] += 1
+
+    insert_rows(cur, 'identifier_hourly',
+                [key + (count,) for key, count in counts.iteritems()],
+                ('hour', 'identifier', 'count'),
+                """
+    ON CONFLICT (hour, identifier) DO UPDATE
+      SET count = identifier_hourly.count + EXCLUDED.count""")
+
+
+def sketch_identifiers(cur, rows):
+    """
+    Add identifier rows to the sketches and occurrence counts per hour in
+    identifier_sketch.
+    """
+    time_index = columns['identifier'].index('time')
+    identifier_index = columns['identifier'].index('identifier')
+
+    by_hour = {}
+    for row in rows:
+        hour = fromPosix(toPosix(row[time_index]) // 3600 * 3600)
+        by_hour.setdefault(hour, []).append(row[identifier_index])
+
+    for hour, identifiers in by_hour.iteritems():
+        # Make sure there is a row to lock, so that concurrent writers merge
+        # into it one at a time rather than overwriting each other.
+        cur.execute("""
+        INSERT INTO
+          identifier_sketch(hour, occurrences, hyperloglog, count_sketch)
+          values (%s, 0, %s, %s)
+        ON CONFLICT (hour) DO NOTHING
+        """, (hour,
+              psycopg2.Binary(sketches.to_bytes(sketches.hyperloglog([]))),
+              psycopg2.Binary(sketches.to_bytes(sketches.count_sketch([])))))
+
+        cur.execute("""
+        SELECT
+          occurrences, hyperloglog, count_sketch
+        FROM
+          identifier_sketch
+        WHERE
+          hour = %s
+        FOR UPDATE
+        """, (hour,))
+        occurrences, hyperloglog, count_sketch = cur.fetchone()
+
+        hyperloglog = numpy.maximum(
+            sketches.hyperloglog_from_bytes(hyperloglog),
+            sketches.hyperloglog(identifiers))
+        count_sketch = sketches.count_sketch_from_bytes(count_sketch) + \
+            sketches.count_sketch(identifiers)
+        cur.execute("""
+        UPDATE
+          identifier_sketch
+        SET
+          occurrences = %s, hyperloglog = %s, count_sketch = %s
+        WHERE
+          hour = %s
+        """, (occurrences + len(identifiers),
+              psycopg2.Binary(sketches.to_bytes(hyperloglog)),
+              psycopg2.Binary(sketches.to_bytes(count_sketch)), hour))
+
+
+def sketch_values(cur, table, rows):
+    """
+    Add the sketched value of rows for the given table to the sketches per
+    hour in value_sketch.
+    """
+    time_index = columns[table].index('time')
+    value_index = columns[table].index(sketched_values[table])
+
+    by_hour = {}
+    for row in rows:
+        hour = fromPosix(toPosix(row[time_index]) // 3600 * 3600)
+        by_hour.setdefault(hour, []).append(row[value_index])
+
+    for hour, values in by_hour.iteritems():
+        # As in sketch_identifiers(), lock a row to merge into.
+        cur.execute("""
+        INSERT INTO
+          value_sketch(hour, source, sketch)
+          values (%s, %s, %s)
+        ON CONFLICT (hour, source) DO NOTHING
+        """, (hour, table,
+              psycopg2.Binary(sketches.to_bytes(sketches.value_sketch([])))))
+
+        cur.execute("""
+        SELECT
+          sketch
+        FROM
+          value_sketch
+        WHERE
+          hour = %s AND source = %s
+        FOR UPDATE
+        """, (hour, table))
+        sketch = sketches.value_sketch_from_bytes(cur.fetchone()[0]) + \
+            sketches.value_sketch(values)
+
+        cur.execute("""
+        UPDATE
+          value_sketch
+        SET
+          sketch = %s
+        WHERE
+          hour = %s AND source = %s
+        """, (psycopg2.Binary(sketches.to_bytes(sketch)), hour, table))
+
+
+def sketched(table):
+    """Return whether results for the table are summarized in sketches."""
+    return table == 'identifier' or table in sketched_values
+
+
+def group_by_table(results):
+    by_table = {}
+    for table, row in results:
+        by_table.setdefault(table, []).append(row)
+    return by_table
+
+
+def write_sketches(cur, results):
+    """
+    Merge a list of (table, row) results into identifier_sketch and
+    value_sketch. This takes three statements per table and hour the results
+    were gathered in.
+    """
+    by_table = group_by_table(results)
+
+    if 'identifier' in by_table:
+        sketch_identifiers(cur, by_table['identifier'])
+
+    for table in sketched_values:
+        if table in by_table:
+            sketch_values(cur, table, by_table[table])
+
+
+def write_results(cur, results, merged=None):
+    """
+    Insert a list of (table, row) results with the given cursor, and if given
+    merge the list of results merged, which were stored earlier, into the
+    sketches. Does not commit. Return the results inserted.
+
+    Inserting takes a constant number of statements regardless of how many
+    results there are: one per table, plus one for identifier_hourly.
+    """
+    by_table = group_by_table(results)
+
+    for table, rows in by_table.iteritems():
+        insert_rows(cur, table, rows)
+
+    if 'identifier' in by_table:
+        rollup_identifiers(cur, by_table['identifier'])
+
+    if merged:
+        write_sketches(cur, merged)
+
+    return results
+
+
+def write_each(cur, results, merged=None):
+    """
+    As write_results(), but insert each result in its own savepoint. Results
+    the database rejects are logged and dropped, and left out of those
+    returned.
+    """
+    written = []
+    for table, row in results:
+        cur.execute("SAVEPOINT result")
+        try:
+            write_results(cur, [(table, row)])
+        except (psycopg2.DataError, psycopg2.IntegrityError), e:
+            logging.error("Dropping {0} result {1}: {2}".format(table, row, e))
+            cur.execute("ROLLBACK TO SAVEPOINT result")
+        else:
+            cur.execute("RELEASE SAVEPOINT result")
+            written.append((table, row))
+
+    if merged:
+        write_sketches(cur, merged)
+
+    return written
+
+
+class ResultSink(service.Service):
+    """
+    Buffers parsed probe results in memory and writes them to the database in
+    one transaction per flush. A flush happens once flush_count results are
+    waiting, every flush_interval seconds, and when the service stops.
+
+    Writes run in the thread of an adbapi.ConnectionPool so that the reactor
+    never waits on the database. Only one flush is in progress at a time.
+    If the database rejects a batch because of its contents the results are
+    retried individually and those which still fail are dropped. If a flush
+    fails otherwise the results are kept and retried on the next flush.
+    Once max_pending results are waiting the sink reports itself full so
+    that probes are not sent faster than they can be stored.
+
+    Each sketch in identifier_sketch and value_sketch is a row of tens of
+    kilobytes which merging rewrites whole, so stored results are merged into
+    them by the first flush in a later hour than the oldest of them, and when
+    the service stops, rather than every flush. If the process exits
+    otherwise, the sketches are missing the results since the last merge
+    until Database.rebuild_derived() is run for those hours.
+    """
+
+    def __init__(self, pool, flush_count, flush_interval, max_pending):
+        self.pool = pool
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.pending = []
+        # When the oldest result in pending was queued.
+        self.pending_since = None
+
+        # Stored results which are not yet merged into the sketches, the
+        # hour since the epoch of the oldest of them, and those being merged
+        # by the flush in progress.
+        self.unmerged = []
+        self.unmerged_hour = None
+        self.merging = None
+
+        # The batch being written, if any, and when its oldest result was
+        # queued.
+        self.flushing = None
+        self.flushing_since = None
+
+        self.flushLoop = LoopingCall(self.flush)
+
+    def full(self):
+        """Return True if no more probes should be sent for now."""
+        return self.waiting() >= self.max_pending
+
+    def waiting(self):
+        """Return the number of results not yet committed."""
+        waiting = len(self.pending)
+        if self.flushing is not None:
+            waiting += len(self.flushing)
+        return waiting
+
+    def lag(self):
+        """
+        Return how many seconds the writer is behind the reactor: the age of
+        the oldest result not yet committed, or zero if there are none.
+        """
+        queued = [since for since in [self.flushing_since, self.pending_since]
+                  if since is not None]
+        if not queued:
+            return 0
+        return time.time() - min(queued)
+
+    def put(self, table, row):
+        """Queue a row for insertion into the given table."""
+        if not self.pending:
+            self.pending_since = time.time()
+        self.pending.append((table, row))
+
+        if len(self.pending) >= self.flush_count:
+            self.flush()
+
+    def flush(self, merge=False):
+        """
+        Start writing all pending results in a single transaction, along with
+        merging stored results into the sketches if it is time to or merge is
+        True. Return a Deferred which fires once it is done. If a flush is
+        already in progress return a Deferred for it instead.
+        """
+        if self.flushing is not None:
+            return self.flushed
+
+        start = time.time()
+        if self.unmerged and (merge or
+                              int(start) // 3600 > self.unmerged_hour):
+            self.merging = self.unmerged
+        elif not self.pending:
+            return defer.succeed(None)
+
+        self.flushing, self.flushing_since = self.pending, self.pending_since
+        self.pending, self.pending_since = [], None
+
+        self.flushed = self.pool.runInteraction(write_results, self.flushing,
+                                                self.merging)
+        self.flushed.addCallbacks(self._stored, self._failed,
+                                  callbackArgs=(start,))
+        return self.flushed
+
+    def _stored(self, written, start):
+        now = time.time()
+        logging.info("Committed {0} results in {1:.3f} seconds. Writer lag "
+                     "was {2:.3f} seconds.".format(len(self.flushing),
+                                                   now - start,
+                                                   now - (self.flushing_since
+                                                          or start)))
+        self.flushing, self.flushing_since = None, None
+
+        if self.merging is not None:
+            logging.info("Merged {0} results into sketches.".format(
+                len(self.merging)))
+            self.unmerged, self.unmerged_hour = [], None
+            self.merging = None
+
+        for table, row in written:
+            if sketched(table):
+                hour = toPosix(row[columns[table].index('time')]) // 3600
+                if self.unmerged_hour is None or hour < self.unmerged_hour:
+                    self.unmerged_hour = hour
+                self.unmerged.append((table, row))
+
+        # Results kept arriving during the write; catch up if enough did.
+        if len(self.pending) >= self.flush_count:
+            self.flush()
+
+    def _failed(self, failure):
+        if failure.check(psycopg2.DataError, psycopg2.IntegrityError):
+            # A result the database will not accept would fail every retry
+            # of the batch. Store the rest without it.
+            logging.warning("Batch of {0} results rejected; storing them "
+                            "one at a time: {1}".format(
+                            len(self.flushing), failure.getErrorMessage()))
+            batch = self.pool.runInteraction(write_each, self.flushing,
+                                             self.merging)
+            batch.addCallbacks(self._stored, self._failed,
+                               callbackArgs=(time.time(),))
+            return batch
+
+        logging.error("Failed to store {0} results; will retry: {1}".format(
+            len(self.flushing), failure.getErrorMessage()))
+
+        # Put the batch back in front of the results which arrived since.
+        # Unmerged results stay as they are, to be merged by a later flush.
+        self.pending = self.flushing + self.pending
+        self.pending_since = self.flushing_since
+        self.flushing, self.flushing_since = None, None
+        self.merging = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.flushLoop.start(self.flush_interval, now=False)
+
+    def stopService(self):
+        """
+        Return a Deferred which fires once everything queued so far has been
+        stored, or storing it has failed.
+        """
+        service.Service.stopService(self)
+        if self.flushLoop.running:
+            self.flushLoop.stop()
+
+        logging.info("Flushing {0} results before shutdown.".format(
+            self.waiting()))
+
+        # Wait for any flush in progress, then flush what arrived since and
+        # merge everything stored into the sketches.
+        return self.flush().addCallback(lambda _: self.flush(merge=True))
@@ -0,0 +1,271 @@
+from __future__ import division
+import sketches
+import numpy
+from collections import deque, namedtuple, Counter
+
+
+def group_hours(rows, count):
+    """
+    Take rows of (hour index, identifier, occurrences) sorted by hour index
+    and yield a Counter of occurrences by identifier for each of count hours
+    in order, including empty ones for hours with no rows.
+    """
+    rows = iter(rows)
+    row = next(rows, None)
+    for hour in xrange(count):
+        occurrences = Counter()
+        while row is not None and row[0] == hour:
+            occurrences[row[1]] += row[2]
+            row = next(rows, None)
+        yield occurrences
+
+
+class SlidingIntersection(object):
+    """
+    Tracks identifiers seen over two adjacent spans of the same number of
+    hours, the previous and the current, as hours are added one at a time.
+
+    Exposes, as distinct, the number of identifiers seen in both spans, and,
+    as samples, the number of pairs of an occurrence in the previous span and
+    an occurrence of the same identifier in the current one. These match
+    db.Database.intersect_identifier() over the same spans.
+
+    Each hour is added, moved from the current span to the previous, and
+    removed once, so the cost is linear in the number of identifiers seen.
+    """
+
+    def __init__(self, length):
+        """
+        :type length: int number of hours in each span.
+        """
+        self.length = length
+        self.hours = deque()
+        self.previous = Counter()
+        self.current = Counter()
+        self.distinct = 0
+        self.samples = 0
+
+    def push(self, occurrences):
+        """
+        Add an hour, given as a Counter of occurrences by identifier, as the
+        latest in the current span.
+        """
+        if len(self.hours) == 2 * self.length:
+            for identifier, count in self.hours.popleft().iteritems():
+                self._change(identifier, -count, 0)
+
+        if len(self.hours) >= self.length:
+            moving = self.hours[-self.length]
+            for identifier, count in moving.iteritems():
+                self._change(identifier, count, -count)
+
+        self.hours.append(occurrences)
+        for identifier, count in occurrences.iteritems():
+            self._change(identifier, 0, count)
+
+    def _change(self, identifier, previous, current):
+        """
+        Add the given occurrences to the previous and current spans for an
+        identifier, and update distinct and samples to match.
+        """
+        before_previous = self.previous[identifier]
+        before_current = self.current[identifier]
+        after_previous = before_previous + previous
+        after_current = before_current + current
+
+        self.samples += after_previous * after_current - \
+            before_previous * before_current
+        self.distinct += (after_previous > 0 and after_current > 0) - \
+            (before_previous > 0 and before_current > 0)
+
+        # Do not keep identifiers which have left both spans.
+        for span, count in [(self.previous, after_previous),
+                            (self.current, after_current)]:
+            if count:
+                span[identifier] = count
+            elif identifier in span:
+                del span[identifier]
+
+
+
+HourSketch = namedtuple('HourSketch', ['occurrences', 'hyperloglog',
+                                       'count_sketch'])
+
+
+def empty_hour():
+    return HourSketch(0, sketches.hyperloglog([]), sketches.count_sketch([]))
+
+
+def group_sketches(rows, count):
+    """
+    Take rows of (hour index, occurrences, HyperLogLog sketch, count sketch)
+    sorted by hour index and yield an HourSketch for each of count hours in
+    order, including empty ones for hours with no rows.
+    """
+    rows = iter(rows)
+    row = next(rows, None)
+    empty = empty_hour()
+    for hour in xrange(count):
+        if row is not None and row[0] == hour:
+            yield HourSketch(*row[1:])
+            row = next(rows, None)
+        else:
+            yield empty
+
+
+class MaxQueue(object):
+    """
+    A queue of HyperLogLog sketches which can give the merge of all of them.
+    Merges cannot be undone, so this keeps the merges of every suffix of the
+    older part of the queue and a running merge of the newer part, which
+    takes a constant number of merges per sketch on average.
+    """
+
+    def __init__(self):
+        self.front = []
+        self.back = []
+        self.back_merged = sketches.hyperloglog([])
+
+    def push(self, sketch):
+        self.back.append(sketch)
+        self.back_merged = numpy.maximum(self.back_merged, sketch)
+
+    def pop(self):
+        if not self.front:
+            # front[-1] is the merge of everything in it, and the oldest
+            # sketch is the last one added.
+            merged = sketches.hyperloglog([])
+            for sketch in reversed(self.back):
+                merged = numpy.maximum(merged, sketch)
+                self.front.append(merged)
+            self.back = []
+            self.back_merged = sketches.hyperloglog([])
+        self.front.pop()
+
+    def merged(self):
+        if self.front:
+            return numpy.maximum(self.front[-1], self.back_merged)
+        return self.back_merged
+
+
+class SlidingSketchIntersection(object):
+    """
+    Approximates SlidingIntersection from sketches of each hour, which merge
+    in time independent of the number of identifiers.
+
+    The number of identifiers seen in both spans comes from the HyperLogLog
+    distinct counts of each span and of their union. The number of samples
+    is the product of the count sketches of the spans.
+    """
+
+    def __init__(self, length):
+        """
+        :type length: int number of hours in each span.
+        """
+        self.length = length
+        self.hours = deque()
+        self.previous = MaxQueue()
+        self.current = MaxQueue()
+        self.previous_counts = numpy.zeros((sketches.depth, sketches.width),
+                                           numpy.int64)
+        self.current_counts = numpy.zeros_like(self.previous_counts)
+        self.distinct = 0
+        self.samples = 0
+
+    def push(self, hour):
+        """
+        Add an hour, given as an HourSketch, as the latest in the current
+        span.
+        """
+        if len(self.hours) == 2 * self.length:
+            oldest = self.hours.popleft()
+            self.previous.pop()
+            self.previous_counts -= oldest.count_sketch
+
+        if len(self.hours) >= self.length:
+            moving = self.hours[-self.length]
+            self.current.pop()
+            self.current_counts -= moving.count_sketch
+            self.previous.push(moving.hyperloglog)
+            self.previous_counts += moving.count_sketch
+
+        self.hours.append(hour)
+        self.current.push(hour.hyperloglog)
+        self.current_counts += hour.count_sketch
+
+        previous = self.previous.merged()
+        current = self.current.merged()
+        # Errors in the estimates can make this negative when the spans
+        # share few identifiers.
+        self.distinct = max(0, sketches.cardinality(previous) +
+                            sketches.cardinality(current) -
+                            sketches.cardinality(numpy.maximum(previous,
+                                                               current)))
+        self.samples = max(0, sketches.inner_product(self.previous_counts,
+                                                     self.current_counts))
+
+
+def solve_size(distinct, samples, min_repeats=3):
+    """
+    Return an array of network sizes N solving
+
+        distinct = N * (1 - e^(-samples / N))
+
+    for arrays (or scalars) of distinct and samples: the size of a network
+    in which drawing samples nodes uniformly at random is expected to find
+    distinct different ones. With fewer than min_repeats samples beyond the
+    distinct ones the estimate is too uncertain to be useful, and is NaN.
+
+    With a = samples / distinct and y = samples / N this is the nonzero root
+    of a * (1 - e^-y) - y, which is concave, so Newton's method started from
+    y = a approaches it from above without overshooting.
+    """
+    distinct = numpy.asarray(distinct, numpy.float64)
+    samples = numpy.asarray(samples, numpy.float64)
+
+    valid = (samples - distinct >= min_repeats) & (distinct > 0)
+    a = numpy.where(valid, samples / numpy.where(valid, distinct, 1), 2)
+    y = a.copy()
+    for _ in xrange(100):
+        step = (a * -numpy.expm1(-y) - y) / (a * numpy.exp(-y) - 1)
+        y -= step
+        if numpy.all(numpy.abs(step) <= 1e-12 * y):
+            break
+
+    return numpy.where(valid, samples / y, numpy.nan)
+
+
+def size_interval(distinct, samples, z=1.96, min_repeats=3):
+    """
+    Return arrays of the estimated size, and the lower and upper bounds of a
+    confidence interval for it, for arrays of distinct and samples as given
+    to solve_size(). z is the number of standard deviations the interval
+    covers: 1.96 is about 95%.
+
+    The number of distinct nodes found by samples uniform draws from N has
+    variance of about N * e^-y - N * (1 + y) * e^-2y with y = samples / N.
+    The bounds are the sizes which would be estimated from z standard
+    deviations fewer and more distinct nodes. The upper bound is infinite
+    if that would be at least as many as there were samples.
+    """
+    distinct = numpy.asarray(distinct, numpy.float64)
+    samples = numpy.asarray(samples, numpy.float64)
+
+    size = solve_size(distinct, samples, min_repeats)
+    y = samples / size
+    deviation = z * numpy.sqrt(numpy.maximum(
+        0, size * numpy.exp(-y) - size * (1 + y) * numpy.exp(-2 * y)))
+
+    # Comparisons with NaN where there is no estimate are expected.
+    with numpy.errstate(invalid='ignore'):
+        lower = solve_size(distinct - deviation, samples, 0)
+        upper_distinct = distinct + deviation
+        upper = numpy.where(upper_distinct < samples,
+                            solve_size(numpy.minimum(upper_distinct,
+                                                     samples - 1),
+                                       samples, 0),
+                            numpy.inf)
+
+    unknown = numpy.isnan(size)
+    return (size, numpy.where(unknown, numpy.nan, lower),
+            numpy.where(unknown, numpy.nan, upper))
@@ -0,0 +1,231 @@
+from __future__ import division
+import zlib
+import numpy
+
+# Mergeable summaries of the identifiers seen in an hour. A HyperLogLog sketch
+# estimates how many distinct identifiers were seen, and merges by taking the
+# maximum of each register. A count sketch estimates how often each was seen,
+# closely enough to estimate the sum over identifiers of the product of how
+# often they were seen in two spans; it merges by adding, and can be
+# subtracted from just as well.
+
+# Number of bits of the hash which select a HyperLogLog register. Distinct
+# counts have a standard error of about 1.04 / sqrt(2 ** precision): 0.8% at
+# 14.
+precision = 14
+registers = 1 << precision
+
+# Bias correction for the harmonic mean of the registers, for 128 or more.
+alpha = 0.7213 / (1 + 1.079 / registers)
+
+_mask = numpy.uint64((1 << (64 - precision)) - 1)
+# 2 ** -rank for each possible register value.
+_powers = numpy.ldexp(1.0, -numpy.arange(64 - precision + 2))
+
+# Count sketch dimensions. Products have a standard error of about
+# 1 / sqrt(width) of the product of the norms of the two sketches, and the
+# median of depth rows is taken to avoid outliers.
+width = 4096
+depth = 5
+
+_golden = numpy.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(x):
+    """Return SplitMix64 of a uint64 array. uint64 arithmetic wraps."""
+    with numpy.errstate(over='ignore'):
+        x = x + _golden
+        x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+        return x ^ (x >> numpy.uint64(31))
+
+
+def hash_identifiers(identifiers):
+    """
+    Return a uint64 array of hashes of an iterable of (signed 64-bit)
+    identifiers. Identifiers are already random, but they are chosen by the
+    nodes, so this does not rely on it.
+    """
+    return _mix(numpy.fromiter(identifiers, numpy.int64).view(numpy.uint64))
+
+
+def hyperloglog(identifiers):
+    """
+    Return the HyperLogLog registers for an iterable of identifiers, as a
+    uint8 array.
+    """
+    hashes = hash_identifiers(identifiers)
+    result = numpy.zeros(registers, numpy.uint8)
+    if not len(hashes):
+        return result
+
+    index = (hashes >> numpy.uint64(64 - precision)).astype(numpy.intp)
+    rest = hashes & _mask
+    # The rank is the position of the highest set bit of the remaining
+    # 64 - precision bits, counted from the top starting at 1. frexp() gives
+    # the bit length exactly, as the remaining bits fit in a double.
+    _, length = numpy.frexp(rest.astype(numpy.float64))
+    rank = (64 - precision + 1 - length).astype(numpy.uint8)
+
+    numpy.maximum.at(result, index, rank)
+    return result
+
+
+def cardinality(sketch):
+    """
+    Return the estimated number of distinct identifiers added to a
+    HyperLogLog sketch or a merge of them.
+    """
+    estimate = alpha * registers ** 2 / _powers[sketch].sum()
+
+    # Linear counting is more accurate for small numbers.
+    if estimate <= 2.5 * registers:
+        zeros = registers - numpy.count_nonzero(sketch)
+        if zeros:
+            return registers * numpy.log(registers / zeros)
+
+    return estimate
+
+
+def count_sketch(identifiers, counts=None):
+    """
+    Return a count sketch of an iterable of identifiers, as an int32 array
+    of depth rows of width counters. If given, counts is an iterable of the
+    number of times each identifier was seen; otherwise each was seen once
+    per time it appears.
+    """
+    hashes = hash_identifiers(identifiers)
+    if counts is None:
+        counts = numpy.ones(len(hashes), numpy.int32)
+    else:
+        counts = numpy.fromiter(counts, numpy.int32)
+
+    result = numpy.zeros((depth, width), numpy.int32)
+    for row in xrange(depth):
+        # Each row uses a different hash, derived from the first.
+        hashes = _mix(hashes)
+        index = (hashes & numpy.uint64(width - 1)).astype(numpy.intp)
+        sign = 1 - 2 * (hashes >> numpy.uint64(63)).astype(numpy.int32)
+        numpy.add.at(result[row], index, sign * counts)
+    return result
+
+
+def inner_product(first, second):
+    """
+    Return the estimated sum over identifiers of the product of the number
+    of times each was added to the first count sketch and to the second.
+    """
+    return numpy.median(numpy.einsum('ij,ij->i', first.astype(numpy.int64),
+                                     second.astype(numpy.int64)))
+
+
+def to_bytes(sketch):
+    """
+    Return a sketch in the form stored in the database. Sketches of an hour
+    are mostly empty, so they are compressed.
+    """
+    return zlib.compress(sketch.tobytes())
+
+
+def from_bytes(data, dtype, shape=None):
+    """
+    Return a sketch of the given element type and shape from the form stored
+    in the database.
+    """
+    sketch = numpy.frombuffer(zlib.decompress(bytes(data)), dtype)
+    if shape is not None:
+        sketch = sketch.reshape(shape)
+    return sketch
+
+
+def hyperloglog_from_bytes(data):
+    return from_bytes(data, numpy.uint8)
+
+
+def count_sketch_from_bytes(data):
+    return from_bytes(data, numpy.int32, (depth, width))
+
+
+# Value sketches summarize numeric results, such as store sizes, in buckets
+# whose bounds grow by a constant factor, so any quantile is within
+# value_accuracy of the true value relative to it. Each bucket holds the number
+# of values in it and their sum, so they merge by adding, and sums over
+# buckets give means. Values at or below value_minimum share a bucket, and
+# values above value_maximum are counted in the highest.
+value_accuracy = 0.01
+value_minimum = 1e-3
+value_maximum = 1e9
+
+_gamma = (1 + value_accuracy) / (1 - value_accuracy)
+value_buckets = int(numpy.ceil(numpy.log(value_maximum / value_minimum) /
+                               numpy.log(_gamma))) + 1
+# Value each bucket stands for in quantiles: the one with the least relative
+# error from anything in it.
+_representative = numpy.concatenate((
+    [0.0], value_minimum * 2 * _gamma ** numpy.arange(1, value_buckets) /
+    (_gamma + 1)))
+
+
+def value_sketch(values):
+    """
+    Return a value sketch of an iterable of numbers, as a float64 array of a
+    row of counts and a row of sums.
+    """
+    values = numpy.fromiter(values, numpy.float64)
+    result = numpy.zeros((2, value_buckets))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        index = numpy.ceil(numpy.log(values / value_minimum) /
+                           numpy.log(_gamma))
+    index = numpy.where(values > value_minimum,
+                        numpy.clip(index, 1, value_buckets - 1),
+                        0).astype(numpy.intp)
+    numpy.add.at(result[0], index, 1)
+    numpy.add.at(result[1], index, values)
+    return result
+
+
+def value_quantiles(sketch, quantiles):
+    """
+    Return an array of the approximate values at each of the given quantiles,
+    between 0 and 1, of the values in a value sketch. They are NaN if it is
+    empty.
+    """
+    counts = sketch[0]
+    total = counts.sum()
+    if not total:
+        return numpy.full(len(quantiles), numpy.nan)
+    # The lowest bucket holding at least the rank of each quantile, counting
+    # from 0, with the same rank as percentile_cont() before interpolation.
+    ranks = numpy.asarray(quantiles) * (total - 1)
+    index = numpy.searchsorted(numpy.cumsum(counts), ranks, side='right')
+    return _representative[numpy.minimum(index, value_buckets - 1)]
+
+
+def outlier_bounds(sketch):
+    """
+    Return a tuple of the lower and upper bounds outside of which values in a
+    value sketch are outliers: 1.5 * interquartile range from the median.
+    """
+    q1, med, q3 = value_quantiles(sketch, [0.25, 0.5, 0.75])
+    outlier_range = 1.5 * (q3 - q1)
+    return med - outlier_range, med + outlier_range
+
+
+def value_mean(sketch, exclude_outliers=False):
+    """
+    Return the mean of the values in a value sketch, or NaN if there are
+    none. If exclude_outliers, buckets outside outlier_bounds() are left out.
+    """
+    counts, sums = sketch
+    if exclude_outliers:
+        lower, upper = outlier_bounds(sketch)
+        inside = (_representative > lower) & (_representative < upper)
+        counts, sums = counts[inside], sums[inside]
+    total = counts.sum()
+    if not total:
+        return float('NaN')
+    return sums.sum() / total
+
+
+def value_sketch_from_bytes(data):
+    return from_bytes(data, numpy.float64, (2, value_buckets))
@@ -0,0 +1,122 @@
+from __future__ import division
+import logging
+import multiprocessing
+import time
+import traceback
+from collections import namedtuple
+from Queue import Empty
+
+# Runs the stages of an analysis, such as updating the RRD and each plot, as a
+# graph of dependencies. Each stage runs in its own process, so it can open
+# its own database connection, and stages which do not depend on each other
+# run at the same time.
+
+# function is called without arguments. dependencies is a list of the names
+# of the stages which must succeed before it starts.
+Stage = namedtuple('Stage', ['name', 'function', 'dependencies'])
+
+
+def run_stages(stages, jobs=1, log=logging.info):
+    """
+    Run a list of Stages, up to jobs at once, each once all of its
+    dependencies have succeeded. Stages which depend on one which failed are
+    skipped. Progress is reported with log().
+
+    Return a list of the names of the stages which failed or were skipped.
+    """
+    names = set(stage.name for stage in stages)
+    for stage in stages:
+        for dependency in stage.dependencies:
+            if dependency not in names:
+                raise ValueError("Stage '{0}' depends on unknown stage "
+                                 "'{1}'.".format(stage.name, dependency))
+
+    results = multiprocessing.Queue()
+    pending = list(stages)
+    running = {}
+    started = {}
+    succeeded = set()
+    failed = []
+
+    while pending or running:
+        skip_failed(pending, failed, log)
+
+        for stage in list(pending):
+            if len(running) >= jobs:
+                break
+            if all(dependency in succeeded
+                   for dependency in stage.dependencies):
+                log("Starting {0}.".format(stage.name))
+                process = multiprocessing.Process(target=run_stage,
+                                                  args=(stage, results),
+                                                  name=stage.name)
+                process.start()
+                running[stage.name] = process
+                started[stage.name] = time.time()
+                pending.remove(stage)
+
+        if not running:
+            if pending:
+                raise ValueError("Stages {0} depend on each other.".format(
+                    ', '.join(stage.name for stage in pending)))
+            break
+
+        name, success = next_result(results, running)
+        running.pop(name).join()
+        if success:
+            log("Finished {0} in {1:.1f} seconds.".format(
+                name, time.time() - started[name]))
+            succeeded.add(name)
+        else:
+            log("{0} failed.".format(name))
+            failed.append(name)
+
+    return failed
+
+
+def skip_failed(pending, failed, log):
+    """
+    Move stages which depend on failed ones, directly or not, from pending to
+    failed.
+    """
+    skipped = True
+    while skipped:
+        skipped = False
+        for stage in list(pending):
+            if any(dependency in failed for dependency in stage.dependencies):
+                log("Skipping {0} because a stage it depends on "
+                    "failed.".format(stage.name))
+                pending.remove(stage)
+                failed.append(stage.name)
+                skipped = True
+
+
+def run_stage(stage, results):
+    try:
+        stage.function()
+    except BaseException:
+        traceback.print_exc()
+        results.put((stage.name, False))
+    else:
+        results.put((stage.name, True))
+
+
+def next_result(results, running):
+    """
+    Wait for a running stage to finish, and return its name and whether it
+    succeeded.
+    """
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Empty:
+            pass
+
+        # A stage puts its result before it exits, so one which has exited
+        # without a result waiting crashed.
+        for name, process in running.iteritems():
+            if not process.is_alive():
+                try:
+                    return results.get_nowait()
+                except Empty:
+                    return name, False
@@ -0,0 +1,229 @@
+from __future__ import division
+import argparse
+import datetime
+import random
+import time
+from ConfigParser import SafeConfigParser
+from psycopg2.tz import FixedOffsetTimezone
+from fnprobe.db import Database, indexes
+from fnprobe.sink import columns, insert_rows
+
+# Compares the index layout before schema version 6, with B-trees on time,
+# against the current one in fnprobe.db.indexes. Each layout is built on
+# temporary copies of the result tables analysis reads most, which are filled
+# with synthetic results the way probe.py writes them, and then queried over
+# random spans as analyze.py does.
+
+parser = argparse.ArgumentParser(description="Benchmark insert throughput "
+                                             "and span query latency of "
+                                             "result table index layouts.")
+parser.add_argument('--rows', dest='rows', default=200000, type=int,
+                    help='Number of identifier results to insert. Other '
+                         'tables get a tenth as many. Default 200000.')
+parser.add_argument('--days', dest='days', default=28, type=int,
+                    help='Number of days the results span. Default 28.')
+parser.add_argument('--batch', dest='batch', default=50, type=int,
+                    help='Results per transaction, as with flushCount in '
+                         'probe.config. Default 50.')
+parser.add_argument('--repeat', dest='repeat', default=20, type=int,
+                    help='Number of times to run each query. Default 20.')
+parser.add_argument('--span-hours', dest='span_hours', default=24, type=int,
+                    help='Length of the queried spans in hours. Default 24.')
+args = parser.parse_args()
+
+config_parser = SafeConfigParser()
+config_parser.read("database.config")
+db = Database(config_parser.defaults())
+# VACUUM cannot run in a transaction.
+db.maintenance.autocommit = True
+cur = db.maintenance.cursor()
+
+tables = ['identifier', 'peer_count', 'refused', 'store_size']
+
+# Index definitions on each table for each layout.
+layouts = [
+    ('B-tree', {
+        'identifier': ['("identifier", "time")', '("time", "identifier")'],
+        'peer_count': ['("time")'],
+        'refused': ['("time")'],
+        'store_size': ['("time")'],
+    }),
+    ('BRIN and covering', dict(
+        (table, [definition for name, index_table, definition in indexes
+                 if index_table == table])
+        for table in tables)),
+]
+
+queries = [
+    ('span_identifier', """
+        SELECT
+          COUNT(DISTINCT "identifier"), COUNT("identifier")
+        FROM
+          benchmark_identifier
+        WHERE
+          time BETWEEN %(start)s AND %(end)s
+        """),
+    ('span_uptimes', """
+        SELECT
+          "percent", count("percent")
+        FROM
+          benchmark_identifier
+        WHERE
+          "time" BETWEEN %(start)s AND %(end)s
+        GROUP BY "percent"
+        """),
+    ('span_peer_count', """
+        SELECT
+          peers, count("peers")
+        FROM
+          benchmark_peer_count
+        WHERE
+          "time" BETWEEN %(start)s AND %(end)s
+        GROUP BY "peers"
+        """),
+    ('span_links', """
+        SELECT
+          unnest("lengths")
+        FROM
+          benchmark_peer_count
+        WHERE
+          "time" BETWEEN %(start)s AND %(end)s
+        """),
+    ('span_refused', """
+        SELECT
+          count(*)
+        FROM
+          benchmark_refused
+        WHERE
+          "time" BETWEEN %(start)s AND %(end)s
+        """),
+    ('span_store_size', """
+        SELECT
+          avg("gib")
+        FROM
+          benchmark_store_size
+        WHERE
+          "time" BETWEEN %(start)s AND %(end)s
+        """),
+]
+
+random.seed(0)
+start = datetime.datetime(2014, 1, 1, tzinfo=FixedOffsetTimezone(0))
+seconds = args.days * 24 * 3600
+
+
+def results(count, values):
+    """
+    Return a list of count rows in time order for sink.insert_rows(), with
+    the values after htl returned by values().
+    """
+    times = sorted(random.randrange(seconds) for _ in xrange(count))
+    return [('benchmark', start + datetime.timedelta(seconds=offset),
+             datetime.timedelta(seconds=random.uniform(1, 30)), 0) + values()
+            for offset in times]
+
+
+def peer_count():
+    peers = random.randrange(1, 40)
+    return peers, [random.random() / 2 for _ in xrange(peers)]
+
+
+identifiers = [random.getrandbits(63) for _ in xrange(args.rows // 10)]
+rows = {
+    'identifier': results(args.rows, lambda: (random.choice(identifiers),
+                                              random.randrange(101))),
+    'peer_count': results(args.rows // 10, peer_count),
+    'refused': results(args.rows // 10, lambda: (random.randrange(10),)),
+    'store_size': results(args.rows // 10,
+                          lambda: (random.lognormvariate(3, 1),)),
+}
+spans = []
+for _ in xrange(args.repeat):
+    span_start = start + datetime.timedelta(
+        seconds=random.randrange(seconds - args.span_hours * 3600))
+    spans.append({'start': span_start,
+                  'end': span_start +
+                  datetime.timedelta(hours=args.span_hours)})
+
+
+def create_tables(layout):
+    for table in tables:
+        cur.execute("""
+        CREATE TEMPORARY TABLE
+          "benchmark_{0}"(LIKE "{0}")
+        """.format(table))
+        cur.execute("""
+        ALTER TABLE
+          "benchmark_{0}"
+        ALTER COLUMN
+          id ADD GENERATED BY DEFAULT AS IDENTITY
+        """.format(table))
+        for definition in layout[table]:
+            cur.execute("""
+            CREATE INDEX ON
+              "benchmark_{0}" {1}
+            """.format(table, definition))
+
+
+def insert(table):
+    """
+    Insert the rows for table in batches and return the seconds it took.
+    """
+    began = time.time()
+    table_rows = rows[table]
+    for index in xrange(0, len(table_rows), args.batch):
+        cur.execute("BEGIN")
+        insert_rows(cur, 'benchmark_' + table,
+                    table_rows[index:index + args.batch], columns[table])
+        cur.execute("COMMIT")
+    return time.time() - began
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+print("{0} identifier results, {1} of others, over {2} days; {3} per "
+      "transaction.".format(args.rows, args.rows // 10, args.days,
+                            args.batch))
+
+for name, layout in layouts:
+    print("")
+    print(name)
+    create_tables(layout)
+
+    for table in tables:
+        elapsed = insert(table)
+        print("  insert {0:>12}: {1:>9.0f} results/second".format(
+            table, len(rows[table]) / elapsed))
+
+    for table in tables:
+        cur.execute('VACUUM ANALYZE "benchmark_{0}"'.format(table))
+    cur.execute("""
+    SELECT
+      sum(pg_indexes_size(c.oid)), sum(pg_relation_size(c.oid))
+    FROM
+      pg_class c
+    WHERE
+      c.relname LIKE 'benchmark\\_%%' AND c.relkind = 'r'
+      AND c.relpersistence = 't'
+    """)
+    index_size, table_size = cur.fetchone()
+    print("  index size: {0:.1f} MiB; table size {1:.1f} MiB".format(
+        index_size / 2 ** 20, table_size / 2 ** 20))
+
+    for query_name, query in queries:
+        # Warm the cache first.
+        cur.execute(query, spans[0])
+        timings = []
+        for span in spans:
+            began = time.time()
+            cur.execute(query, span)
+            cur.fetchall()
+            timings.append(time.time() - began)
+        print("  {0:>16}: median {1:>8.2f} ms, max {2:>8.2f} ms".format(
+            query_name, median(timings) * 1000, max(timings) * 1000))
+
+    for table in tables:
+        cur.execute('DROP TABLE "benchmark_{0}"'.format(table))
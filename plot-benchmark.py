@@ -0,0 +1,120 @@
+from __future__ import division
+import argparse
+import functools
+import logging
+import multiprocessing
+import numpy
+import os
+import resource
+import shutil
+import tempfile
+import time
+from fnprobe.db import reject_types
+from fnprobe.gnuplots import plot_link_length, plot_location_dist, \
+    plot_peer_count, plot_bulk_reject, plot_uptime, link_length_edges
+from fnprobe.plotting import backends
+from fnprobe.reference import link_length_cdf
+from fnprobe.stages import Stage, run_stages
+
+# Compares plotting backends by rendering the plots analyze.py makes from
+# synthetic results, each in its own stage as analyze.py does. Each backend
+# runs in its own process so that its peak memory use, and that of the
+# stages it renders in, is measured separately.
+
+parser = argparse.ArgumentParser(description="Benchmark wall time and peak "
+                                             "memory of plotting backends.")
+parser.add_argument('--backends', dest='backends',
+                    default=','.join(sorted(backends)),
+                    help='Comma-separated list of backends to compare. '
+                         'Default all of them.')
+parser.add_argument('--jobs', dest='jobs',
+                    default=multiprocessing.cpu_count(), type=int,
+                    help='Number of stages to render plots in at once. '
+                         'Defaults to the number of CPUs.')
+parser.add_argument('--repeat', dest='repeat', default=5, type=int,
+                    help='Number of times to render the plots. Default 5.')
+parser.add_argument('--links', dest='links', default=2000000, type=int,
+                    help='Number of link lengths to plot. Default 2000000.')
+args = parser.parse_args()
+
+random = numpy.random.RandomState(0)
+peer_counts = numpy.column_stack((numpy.arange(1, 153),
+                                  random.randint(1000, size=152)))
+uptimes = numpy.column_stack((numpy.arange(121),
+                              random.randint(1000, size=121)))
+rejects = dict((reject_type, random.randint(1000, size=101))
+               for reject_type in reject_types)
+
+
+def make_plots(output_dir):
+    """
+    Return a list of the plots analyze.py makes, as Plots to be written to
+    output_dir.
+    """
+    def path(name):
+        return os.path.join(output_dir, name)
+
+    references = [(title, link_length_cdf(kind, link_length_edges))
+                  for title, kind in [('Ideal', 'kleinberg'),
+                                      ('Flat', 'uniform')]]
+    return [
+        plot_location_dist([random.random_sample(args.links)],
+                           filename=path('plot_location_dist.png')),
+        plot_peer_count(peer_counts, 152,
+                        filename=path('plot_peer_count.png')),
+        plot_link_length([random.random_sample(args.links) / 2], references,
+                         filename=path('plot_link_length.png')),
+        plot_uptime(uptimes, 120, filename=path('plot_week_uptime.png')),
+        plot_bulk_reject(rejects,
+                         filename=path('plot_week_reject.png')),
+    ]
+
+
+def run(backend, plots, output):
+    """
+    Render the plots with backend, and put the seconds it took, and the peak
+    resident memory in KiB of this process and of any it started, on the
+    output queue.
+    """
+    render = backends[backend]
+    stages = [Stage(os.path.basename(plot.filename),
+                    functools.partial(render, plot), [])
+              for plot in plots]
+
+    began = time.time()
+    for _ in xrange(args.repeat):
+        if run_stages(stages, args.jobs, logging.debug):
+            raise RuntimeError("Could not render plots.")
+    elapsed = time.time() - began
+
+    output.put((elapsed,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+
+
+print("{0} link lengths and locations; {1} jobs; rendered {2} times.".format(
+    args.links, args.jobs, args.repeat))
+
+# The plots are made before starting the process for each backend, which
+# begins with the memory in use at the time rather than the peak so far.
+output_dir = tempfile.mkdtemp()
+plots = make_plots(output_dir)
+
+for backend in args.backends.split(','):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run,
+                                      args=(backend, plots, results))
+    process.start()
+    # The results are small enough not to block the process from exiting.
+    process.join()
+    if process.exitcode != 0:
+        print("{0:>12}: failed".format(backend))
+        continue
+    elapsed, self_rss, children_rss = results.get()
+
+    print("{0:>12}: {1:>7.2f} seconds per run; peak memory {2:.1f} MiB, "
+          "{3:.1f} MiB in renderers".format(backend, elapsed / args.repeat,
+                                            self_rss / 1024,
+                                            children_rss / 1024))
+
+shutil.rmtree(output_dir)
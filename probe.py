@@ -1,9 +1,7 @@
 from __future__ import division
 import exceptions
-import random
 import datetime
-from twisted.internet import protocol
-from twisted.internet.task import LoopingCall
+from twisted.internet import protocol, threads
 import logging
 from twisted.application import service
 from ConfigParser import SafeConfigParser
@@ -13,8 +11,13 @@ from twistedfcp.protocol import FreenetClientProtocol, IdentifiedMessage
 from twisted.python import log
 from fnprobe import update_db
 from fnprobe.db import probeTypes, errorTypes
+from fnprobe.sink import ResultSink
+from fnprobe import scheduler
+from fnprobe.sampling import TypeSelector, DistinctEstimate, parse_weights
+from fnprobe.time_utils import totalSeconds
 from psycopg2.tz import LocalTimezone
 from twisted.application import internet
+from twisted.enterprise import adbapi
 
 __version__ = "0.1"
 application = service.Application("pyProbe")
@@ -23,9 +26,6 @@ application = service.Application("pyProbe")
 #information at INFO.
 application.setComponent(ILogObserver, log.PythonLoggingObserver().emit)
 
-#Which random generator to use.
-rand = random.SystemRandom()
-
 #FCP Message fields
 BANDWIDTH = "OutputBandwidth"
 BUILD = "Build"
@@ -44,9 +44,7 @@ HTL = "HopsToLive"
 LOCAL = "Local"
 
 
-def insert(conn, config, probe_type, result, duration, now):
-    start = datetime.datetime.utcnow()
-
+def store(sink, config, probe_type, result, duration, now):
     header = result.name
     htl = config['hopsToLive']
     try:
@@ -55,17 +53,25 @@ def insert(conn, config, probe_type, result, duration, now):
         logging.error("Could not get type %s", probe_type)
         return
 
-    insertResult(conn.cursor(), header, htl, result, now, duration,
-                 probe_type, probe_type_code)
+    parsed = parseResult(header, htl, result, now, duration, probe_type,
+                         probe_type_code)
+    if parsed is None:
+        return
 
-    conn.commit()
-    logging.debug("Committed {0} ({1}) in {2}.".format(header, probe_type,
-                                                       datetime.datetime.utcnow() - start))
+    table, row = parsed
+    sink.put(table, (config['name'],) + row)
+    logging.debug("Queued {0} ({1}) from {2}.".format(header, probe_type,
+                                                      config['name']))
 
 
 # TODO: Would it make more sense to put some of these arguments in a dictionary?
-def insertResult(cur, header, htl, result, now, duration, probe_type,
-                 probe_type_code):
+def parseResult(header, htl, result, now, duration, probe_type,
+                probe_type_code):
+    """
+    Return a (table, row) tuple for the result, with the row in the column
+    order given in fnprobe.sink.columns but without the node, or None if the
+    type is unrecognized.
+    """
     if header == "ProbeError":
         #type should always be defined, but the code might not be.
         code = None
@@ -77,7 +83,8 @@ def insertResult(cur, header, htl, result, now, duration, probe_type,
         elif result[LOCAL] == "false":
             local = False
         else:
-            # This will result in a constraint violation. Local cannot be null.
+            # This would result in a constraint violation. Local cannot be
+            # null.
             logging.error("Node gave '{0}' as ProbeError Local, "
                           "which is neither 'true' nor 'false'.".format(
                           result[LOCAL]))
@@ -85,92 +92,80 @@ def insertResult(cur, header, htl, result, now, duration, probe_type,
 
         error_type = getattr(errorTypes, result[TYPE]).value
 
-        cur.execute("""
-        INSERT INTO
-          error(time, duration, htl, probe_type, error_type, local, code)
-          values(%s, %s, %s, %s, %s, %s, %s)
-        """, (now, duration, htl, probe_type_code, error_type, local, code))
+        return ('error', (now, duration, htl, probe_type_code, error_type,
+                          local, code))
     elif header == "ProbeRefused":
-        cur.execute("""
-        INSERT INTO
-          refused(time, duration, htl, probe_type)
-          values(%s, %s, %s, %s)
-        """, (now, duration, htl, probe_type_code))
+        return 'refused', (now, duration, htl, probe_type_code)
     elif probe_type == "BANDWIDTH":
-        cur.execute("""
-        INSERT INTO
-          bandwidth(time, duration, htl, KiB)
-          values(%s, %s, %s, %s)
-        """, (now, duration, htl, result[BANDWIDTH]))
+        return 'bandwidth', (now, duration, htl, result[BANDWIDTH])
     elif probe_type == "BUILD":
-        cur.execute("""
-        INSERT INTO
-          build(time, duration, htl, build)
-          values(%s, %s, %s, %s)
-        """, (now, duration, htl, result[BUILD]))
+        return 'build', (now, duration, htl, result[BUILD])
     elif probe_type == "IDENTIFIER":
-        cur.execute("""
-        INSERT INTO
-          identifier(time, duration, htl, identifier, percent)
-          values(%s, %s, %s, %s, %s)
-        """, (now, duration, htl, result[PROBE_IDENTIFIER],
-              result[UPTIME_PERCENT]))
+        # Parsed here to be counted by hour in the sink.
+        return ('identifier', (now, duration, htl,
+                               long(result[PROBE_IDENTIFIER]),
+                               result[UPTIME_PERCENT]))
     elif probe_type == "LINK_LENGTHS":
-        lengths = split(result[LINK_LENGTHS], ';')
-        cur.execute("""
-        INSERT INTO
-          peer_count(time, duration, htl, peers)
-          values(%s, %s, %s, %s)
-        RETURNING
-          id
-        """, (now, duration, htl, len(lengths)))
-        # PostgreSQL does not use OIDs by default, which would be exposed on
-        # lastrowid. As a PostgreSQL extension to SQL it can return values from
-        # an insert.
-        peer_count_id = cur.fetchone()[0]
-        for length in lengths:
-            cur.execute("""
-            INSERT INTO
-              link_lengths(length, count_id)
-              values(%s, %s)
-            """, (length, peer_count_id))
+        # A node without peers reports no lengths.
+        lengths = [float(length) for length in
+                   split(result[LINK_LENGTHS], ';') if length]
+        return 'peer_count', (now, duration, htl, len(lengths), lengths)
     elif probe_type == "LOCATION":
-        cur.execute("""
-        INSERT INTO
-          location(time, duration, htl, location)
-          values(%s, %s, %s, %s)
-        """, (now, duration, htl, result[LOCATION]))
+        return 'location', (now, duration, htl, result[LOCATION])
     elif probe_type == "REJECT_STATS":
-        cur.execute("""
-        INSERT INTO
-          reject_stats(time, duration, htl, bulk_request_chk, bulk_request_ssk,
-                       bulk_insert_chk, bulk_insert_ssk)
-          values(%s, %s, %s, %s, %s, %s, %s)
-        """, (now, duration, htl, result[REJECT_BULK_REQUEST_CHK],
-              result[REJECT_BULK_REQUEST_SSK], result[REJECT_BULK_INSERT_CHK],
-              result[REJECT_BULK_INSERT_SSK]))
+        return ('reject_stats', (now, duration, htl,
+                                 result[REJECT_BULK_REQUEST_CHK],
+                                 result[REJECT_BULK_REQUEST_SSK],
+                                 result[REJECT_BULK_INSERT_CHK],
+                                 result[REJECT_BULK_INSERT_SSK]))
     elif probe_type == "STORE_SIZE":
-        cur.execute("""
-        INSERT INTO
-          store_size(time, duration, htl, GiB)
-          values(%s, %s, %s, %s)
-        """, (now, duration, htl, result[STORE_SIZE]))
+        return 'store_size', (now, duration, htl, result[STORE_SIZE])
     elif probe_type == "UPTIME_48H":
-        cur.execute("""
-        insert into
-          uptime_48h(time, duration, htl, percent)
-          values(%s, %s, %s, %s)
-        """, (now, duration, htl, result[UPTIME_PERCENT]))
+        return 'uptime_48h', (now, duration, htl, result[UPTIME_PERCENT])
     elif probe_type == "UPTIME_7D":
-        cur.execute("""
-        INSERT INTO
-          uptime_7d(time, duration, htl, percent)
-          values(%s, %s, %s, %s)
-        """, (now, duration, htl, result[UPTIME_PERCENT]))
+        return 'uptime_7d', (now, duration, htl, result[UPTIME_PERCENT])
     else:
         logging.warning("Unrecognized result type '%s'" % probe_type)
 
 
+def estimateValue(probe_type, result):
+    """
+    Return the value from a result which is used to judge how precise the
+    estimate made from its type is, or None if there is none. See
+    fnprobe.sampling.TypeSelector.
+    """
+    try:
+        if probe_type == "IDENTIFIER":
+            # Network size is estimated from repeated identifiers.
+            return result[PROBE_IDENTIFIER]
+        elif probe_type == "LINK_LENGTHS":
+            # Peer count.
+            return len([length for length in split(result[LINK_LENGTHS], ';')
+                        if length])
+        elif probe_type == "REJECT_STATS":
+            # A negative percentage means no data, and would bias the mean.
+            value = float(result[REJECT_BULK_REQUEST_CHK])
+            if value < 0:
+                return None
+            return value
+        elif probe_type in estimateFields:
+            return float(result[estimateFields[probe_type]])
+    except (KeyError, ValueError):
+        pass
+
+    return None
+
+# Field with the value for estimateValue() for types with a single value.
+estimateFields = {
+    "BANDWIDTH": BANDWIDTH,
+    "BUILD": BUILD,
+    "LOCATION": LOCATION,
+    "STORE_SIZE": STORE_SIZE,
+    "UPTIME_48H": UPTIME_PERCENT,
+    "UPTIME_7D": UPTIME_PERCENT,
+}
+
+
 #Inactive class for holding arguments in attributes.
 class Arguments(object):
     pass
@@ -181,35 +176,87 @@ def MakeRequest(ProbeType, HopsToLive):
                              [(TYPE, ProbeType), (HTL, HopsToLive)])
 
 
+def send(config, proto, sink, probeScheduler, selector):
+    """
+    Send a probe unless the sink is too far behind to accept more results.
+    Return whether a probe was sent.
+    """
+    if sink.full():
+        logging.warning("Not sending probe: {0} results are waiting to be "
+                        "stored. Writer lag is {1:.3f} seconds.".format(
+                        sink.waiting(), sink.lag()))
+        return False
+
+    SendHook(config, proto, sink, probeScheduler, selector)
+    return True
+
+
 class SendHook:
     """
-    Sends a probe of a random type and commits the result to the database.
+    Sends a probe of a type chosen by the selector, queues the result for
+    storage, and reports the outcome to the scheduler and the selector.
     """
     class Log:
+        def __init__(self, hook):
+            self.hook = hook
+
         def __call__(self, message):
             logging.error(message)
+            self.hook.finish(scheduler.FAILED)
 
-    def __init__(self, config, proto, conn):
+    def __init__(self, config, proto, sink, probeScheduler, selector):
         self.sent = datetime.datetime.now(LocalTimezone())
         self.config = config
-        self.probeType = random.choice(self.config['types'])
-        self.conn = conn
+        self.selector = selector
+        self.probeType = selector.choose()
+        self.sink = sink
+        self.scheduler = probeScheduler
+        self.generation = probeScheduler.generation
+        self.finished = False
         logging.debug("Sending {0}.".format(self.probeType))
 
         request = proto.do_session(MakeRequest(self.probeType,
                                                self.config['hopsToLive']),
                                    self)
 
-        request.addErrback(SendHook.Log())
+        request.addErrback(SendHook.Log(self))
 
     def __call__(self, message):
         now = datetime.datetime.now(LocalTimezone())
         # TODO: This may be inaccurate or even negative due to time changes.
         # However Python 2 does not have Python 3.3's time.monotonic().
         duration = now - self.sent
-        insert(self.conn, self.config, self.probeType, message, duration, now)
+
+        # The outcome is reported before storing the result so that a result
+        # which cannot be stored still returns its outstanding slot to the
+        # scheduler.
+        if message.name == "ProbeRefused":
+            outcome = scheduler.REFUSED
+        elif message.name == "ProbeError" and TYPE in message and \
+                message[TYPE] == "OVERLOAD":
+            outcome = scheduler.OVERLOAD
+        else:
+            outcome = scheduler.RESULT
+            value = estimateValue(self.probeType, message)
+            if value is not None:
+                self.selector.observe(self.probeType, value)
+        self.finish(outcome, totalSeconds(duration))
+
+        try:
+            store(self.sink, self.config, self.probeType, message, duration,
+                  now)
+        except (AttributeError, KeyError, TypeError, ValueError), e:
+            logging.error("Could not parse {0} ({1}) from {2}: {3!r}".format(
+                message.name, self.probeType, self.config['name'], e))
+
         return True
 
+    def finish(self, outcome, duration=None):
+        # Report only once even if the session both responds and fails.
+        if not self.finished:
+            self.finished = True
+            self.scheduler.finished(self.generation, outcome, duration)
+
 
 class FCPReconnectingFactory(protocol.ReconnectingClientFactory):
     """A protocol factory that uses FCP."""
@@ -218,9 +265,18 @@ class FCPReconnectingFactory(protocol.ReconnectingClientFactory):
     #Log disconnection and reconnection attempts
     noisy = True
 
-    def __init__(self, config, conn):
+    def __init__(self, config, sink):
         self.config = config
-        self.conn = conn
+        self.sink = sink
+        # Kept across reconnections so that the adapted rate and weights are
+        # too.
+        self.scheduler = scheduler.ProbeScheduler(config['probeRate'],
+                                                  config['burst'],
+                                                  config['maxOutstanding'])
+        self.selector = TypeSelector(config['types'], config['adaptiveTypes'],
+                                     config['adaptInterval'],
+                                     config['maxWeightShift'],
+                                     {'IDENTIFIER': DistinctEstimate})
 
     def buildProtocol(self, _):
         proto = FreenetClientProtocol()
@@ -228,17 +284,17 @@ class FCPReconnectingFactory(protocol.ReconnectingClientFactory):
         proto.timeout = self.config['timeout']
 
         proto.deferred['NodeHello'] = self
-
-        self.sendLoop = LoopingCall(SendHook, self.config, proto, self.conn)
+        self.proto = proto
 
         return proto
 
     def callback(self, _):
-        self.sendLoop.start(self.config['probePeriod'])
+        self.scheduler.start(lambda: send(self.config, self.proto, self.sink,
+                                          self.scheduler, self.selector))
 
     def clientConnectionLost(self, connector, reason):
         logging.warning("Lost connection: {0}".format(reason))
-        self.sendLoop.stop()
+        self.scheduler.stop()
 
         #Any connection loss is failure; reconnect.
         protocol.ReconnectingClientFactory.clientConnectionFailed(self,
@@ -246,48 +302,115 @@ class FCPReconnectingFactory(protocol.ReconnectingClientFactory):
                                                                   reason)
 
 
+def createPartitions(database):
+    """
+    Create upcoming result table partitions in a thread, as the DDL can wait
+    on locks and the reactor must not. Failure is logged rather than passed
+    on, which would stop the daily timer, so it is tried again the next day.
+    """
+    def create():
+        try:
+            database.create_partitions()
+        except Exception:
+            database.maintenance.rollback()
+            raise
+
+    def failed(failure):
+        logging.error("Could not create partitions: {0}".format(
+            failure.getErrorMessage()))
+
+    return threads.deferToThread(create).addErrback(failed)
+
+
+def convert(config):
+    """Convert options in the configuration from strings."""
+    #Convert integer options
+    for arg in ["port", "hopsToLive", "probeRate", "burst", "maxOutstanding",
+                "flushCount", "maxPending"]:
+        config[arg] = int(config[arg])
+
+    #Convert floating point options.
+    for arg in ["timeout", "databaseTimeout", "flushInterval",
+                "adaptInterval", "maxWeightShift"]:
+        config[arg] = float(config[arg])
+
+    config['adaptiveTypes'] = config['adaptiveTypes'].lower() == "true"
+
+    #Convert types list to list of (type, weight)
+    config['types'] = parse_weights(config['types'])
+
+
 def main():
     config_parser = SafeConfigParser()
     # Case-sensitive option names.
     config_parser.optionxform = str
-    config_parser.read("probe.config")
+    # Options added since probe.config was made from the sample take their
+    # defaults from the sample.
+    config_parser.read(["probe.config_sample", "probe.config"])
     config = config_parser.defaults()
 
+    # This modifies the defaults themselves, so node sections inherit the
+    # overrides too.
     for arg, value in config_parser.items('OVERRIDE'):
         config[arg] = value
 
-    #Convert integer options
-    for arg in ["port", "hopsToLive", "probeRate"]:
-        config[arg] = int(config[arg])
-
-    #Convert floating point options.
-    for arg in ["timeout", "databaseTimeout"]:
-        config[arg] = float(config[arg])
-
-    #Convert types list to list
-    config['types'] = split(config['types'], ",")
+    # Each node has its own section if nodes are listed, and is otherwise
+    # configured by the defaults. Read these before converting the defaults,
+    # which the parser requires to be strings.
+    if config['nodes']:
+        names = [name.strip() for name in split(config['nodes'], ",")]
+        nodes = [dict(config_parser.items(name), name=name)
+                 for name in names if name]
+    else:
+        nodes = [dict(config, name="{0}:{1}".format(config['host'],
+                                                    config['port']))]
 
-    # Compute probe period. Rate is easier to think about, so it's used in the
-    # config file. probeRate is probes/minute. Period is seconds/probe.
-    # 60 seconds   1 minute           seconds
-    # ---------- * ---------------- = -------
-    # 1 minute     probeRate probes   probe
-    config['probePeriod'] = 60 / config['probeRate']
+    config = dict(config)
+    for node in [config] + nodes:
+        convert(node)
 
     logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s",
                         level=getattr(logging, config['verbosity']),
                         filename=config['logFile'])
     logging.info("Starting up.")
 
-    conn = update_db.main(log_to_stdout=False).add
+    database = update_db.main(log_to_stdout=False)
+
+    # A single connection keeps results in order and is all one flush at a
+    # time needs. Reconnect if the database goes away.
+    pool = adbapi.ConnectionPool('psycopg2', cp_min=1, cp_max=1,
+                                 cp_reconnect=True, cp_noisy=True,
+                                 **database.add_parameters)
+
+    # Services stop in the reverse order they were added, so the connections
+    # to the nodes close before the sink makes its final flush.
+    collector = service.MultiService()
+
+    sink = ResultSink(pool, config['flushCount'], config['flushInterval'],
+                      config['maxPending'])
+    sink.setServiceParent(collector)
+
+    # Keep result table partitions ahead of the results being added.
+    partitions = internet.TimerService(24 * 60 * 60, createPartitions,
+                                       database)
+    partitions.setServiceParent(collector)
+
+    # Each node has its own connection, reconnection, and scheduler, and all
+    # share the sink.
+    for node in nodes:
+        logging.info("Probing {0} at {1}:{2}.".format(node['name'],
+                                                      node['host'],
+                                                      node['port']))
+        client = internet.TCPClient(node['host'], node['port'],
+                                    FCPReconnectingFactory(node, sink))
+        client.setServiceParent(collector)
 
-    return internet.TCPClient(config['host'], config['port'],
-                              FCPReconnectingFactory(config, conn))
+    return collector
 
 # Run with twistd: set up application; let it start the reactor.
 if __name__ == "__builtin__":
-    client = main()
-    client.setServiceParent(application)
+    collector = main()
+    collector.setServiceParent(application)
 
 # Run as a script: complain.
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+from __future__ import division
+import argparse
+import datetime
+import math
+import time
+from ConfigParser import SafeConfigParser
+from fnprobe.db import Database
+from fnprobe.sketches import cardinality
+from fnprobe.size import SlidingIntersection, group_hours, \
+    SlidingSketchIntersection, group_sketches, solve_size
+from fnprobe.time_utils import get_midnight
+
+# Compares the distinct identifier counts, samples, and size estimates
+# analyze.py computes with --approximate against the exact ones, over the same
+# stored data.
+
+parser = argparse.ArgumentParser(description="Report how far network size "
+                                             "estimation inputs from "
+                                             "identifier sketches are from "
+                                             "exact counts.")
+parser.add_argument('--up-to', dest='up_to', default='',
+                    help='Compare hours up to midnight on the given date. '
+                         'Defaults to today.')
+parser.add_argument('--hours', dest='hours', default=168, type=int,
+                    help='Number of hours to compare. Default 168.')
+args = parser.parse_args()
+
+config_parser = SafeConfigParser()
+config_parser.read("database.config")
+db = Database(config_parser.defaults(), read_only=True)
+
+hour = datetime.timedelta(hours=1)
+spans = [('weekly', 168), ('daily', 24)]
+# Enough hours before the first compared to fill the longest spans.
+primed = 2 * max(length for _, length in spans) - 1
+
+end = get_midnight(args.up_to)
+start = end - (args.hours + primed) * hour
+
+
+def compare(hours, Intersection, distinct_and_samples):
+    """
+    Return a dict of span name to lists of the distinct count, samples, and
+    estimated size for each compared hour, and how many seconds it took
+    including reading.
+    """
+    began = time.time()
+    intersections = [(name, Intersection(length)) for name, length in spans]
+    values = dict((name, ([], [])) for name, _ in spans + [('hourly', 1)])
+    for index, occurrences in enumerate(hours):
+        for name, intersection in intersections:
+            intersection.push(occurrences)
+            if index >= primed:
+                values[name][0].append(intersection.distinct)
+                values[name][1].append(intersection.samples)
+        if index >= primed:
+            distinct, samples = distinct_and_samples(occurrences)
+            values['hourly'][0].append(distinct)
+            values['hourly'][1].append(samples)
+    for name, (distinct, samples) in values.items():
+        values[name] = (distinct, samples, list(solve_size(distinct, samples)))
+    return values, time.time() - began
+
+
+count = args.hours + primed
+exact, exact_seconds = compare(
+    group_hours(db.hourly_identifiers(start, end, hour), count),
+    SlidingIntersection,
+    lambda occurrences: (len(occurrences), sum(occurrences.itervalues())))
+approximate, approximate_seconds = compare(
+    group_sketches(db.hourly_sketches(start, end), count),
+    SlidingSketchIntersection,
+    lambda sketch: (cardinality(sketch.hyperloglog), sketch.occurrences))
+
+print("Compared {0} hours from {1} to {2}.".format(args.hours,
+                                                  start + primed * hour, end))
+print("Exact took {0:.2f} seconds; approximate took {1:.2f} seconds.".format(
+    exact_seconds, approximate_seconds))
+print("{0:>8} {1:>9} {2:>14} {3:>14} {4:>14}".format(
+    'span', 'value', 'mean exact', 'mean error', 'max error'))
+
+for name in ['hourly'] + [name for name, _ in spans]:
+    for label, index in [('distinct', 0), ('samples', 1), ('size', 2)]:
+        # Sizes are NaN where there was not enough information.
+        pairs = [(e, a) for e, a in zip(exact[name][index],
+                                        approximate[name][index])
+                 if e and not math.isnan(e) and not math.isnan(a)]
+        if not pairs:
+            print("{0:>8} {1:>9} {2:>14}".format(name, label, 'no data'))
+            continue
+        errors = [abs(a - e) / e for e, a in pairs]
+        print("{0:>8} {1:>9} {2:>14.1f} {3:>13.2%} {4:>13.2%}".format(
+            name, label, sum(e for e, _ in pairs) / len(pairs),
+            sum(errors) / len(errors), max(errors)))
@@ -0,0 +1,45 @@
+import unittest
+from twisted.internet.task import Clock
+from fnprobe.scheduler import ProbeScheduler, RESULT, OVERLOAD
+
+
+class ProbeSchedulerTest(unittest.TestCase):
+    """Run with python -m unittest discover tests from the repository."""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = ProbeScheduler(120, 5, 10, clock=self.clock)
+        self.scheduler.start(lambda: True)
+        # Fill the bucket and send a burst.
+        self.clock.advance(10)
+
+    def test_sends_burst(self):
+        self.assertEqual(self.scheduler.outstanding, 5)
+
+    def test_finished_after_stop_is_ignored(self):
+        generation = self.scheduler.generation
+        self.scheduler.stop()
+        self.scheduler.finished(generation, OVERLOAD, 1.0)
+        self.scheduler.finished(generation, RESULT, 1.0)
+
+        self.assertEqual(self.scheduler.outstanding, 0)
+        self.assertEqual(self.scheduler.rate(), 120)
+
+    def test_finished_after_restart_is_ignored(self):
+        generation = self.scheduler.generation
+        self.scheduler.stop()
+        self.scheduler.start(lambda: False)
+        self.scheduler.finished(generation, OVERLOAD, 1.0)
+
+        self.assertEqual(self.scheduler.outstanding, 0)
+        self.assertEqual(self.scheduler.rate(), 120)
+
+    def test_overload_decreases_rate(self):
+        self.scheduler.finished(self.scheduler.generation, OVERLOAD, 1.0)
+
+        self.assertEqual(self.scheduler.outstanding, 4)
+        self.assertEqual(self.scheduler.rate(), 90)
+
+
+if __name__ == '__main__':
+    unittest.main()